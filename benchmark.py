@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for dfstran, run over synthetic disc images.
+
+Each scenario generates an image, then times cataloguing it from the
+command line in a new interpreter (the cold start of a single run), reading
+its catalogue, cataloguing it at each verbosity, unpacking it, reading the
+unpacked directory back, fitting its files and packing it again.  The best
+time of several runs of each is reported as JSON, which can be kept as a
+baseline and compared against later runs.
+'''
+
+from __future__ import print_function
+import os
+import os.path
+import shutil
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import dfstran
+from dfstran import sectorlen
+
+class SyntheticFile(dfstran.DfsFile):
+    '''
+    A file held in memory, for building synthetic disc images
+    '''
+    def __init__(self, catnum, name, start_sector, data):
+        super(SyntheticFile, self).__init__()
+        self.catnum=catnum
+        self.dir='$'
+        self.name=name
+        self.start_sector=start_sector
+        self.len=len(data)
+        self.data=bytes(data)
+
+    def read(self):
+        return self.data
+
+    def read_after(self):
+        return b'\xe5'*(-self.len%sectorlen)
+
+class SyntheticDisc(dfstran.DfsDisc):
+    '''
+    A disc image generated from a description of its layout.
+
+    Arguments:
+    - tracks: 40 or 80 (10 sectors each)
+    - sizes: the length of each file, in catalogue order; files are laid out
+      from sector 2 in that order
+    - gap: the number of free sectors left after each file, to fragment the
+      free space
+    - crop: True to crop the image just after the last file
+    - extra: data to add after the end of the disc image
+    - seed: for the random file contents, so runs are repeatable
+    '''
+    def __init__(self, tracks, sizes, gap=0, crop=False, extra=b'', seed=0):
+        super(SyntheticDisc, self).__init__()
+        rng=random.Random(seed)
+        self.title='BENCH{}'.format(tracks)
+        self.serial_no=seed & 0xff
+        self.sectors=tracks*dfstran.tracksectors
+        self.boot_options=3
+        self.additional=extra
+        sector=2
+        for (catnum, size) in enumerate(sizes):
+            data=bytearray([rng.getrandbits(8) for i in range(size)])
+            self.cat.append(
+              SyntheticFile(catnum, 'F{:02d}'.format(catnum), sector, data)
+            )
+            sector+=-(-size//sectorlen)+gap
+        if sector-gap>self.sectors:
+            raise ValueError('Files don\'t fit on a {} track disc'.format(tracks))
+        used=set([0, 1])
+        for f in self.cat:
+            used.update(range(f.start_sector, f.start_sector-(-f.len//sectorlen)))
+        self.unused=[s for s in range(self.sectors) if s not in used]
+        self.ssd_size=self.sectors*sectorlen+len(extra)
+        if crop:
+            self.ssd_size=(max(used)+1)*sectorlen
+
+    def list_unused_sectors(self):
+        return self.unused
+
+    def read_sector(self, sector):
+        if sector<=1:
+            return self.catalogue_sectors()[sector]
+        return bytes(bytearray([sector & 0xff]))*sectorlen
+
+    def read_unused_catalogue(self):
+        return [b'', b'']
+
+def filling(tracks, files, slack=17):
+    '''
+    Return the sizes of files of equal numbers of sectors filling a disc,
+    each slack bytes short of its last sector
+    '''
+    each=(tracks*dfstran.tracksectors-2)//files
+    return [each*sectorlen-slack]*files
+
+# Modules dfstran mustn't import until a command needs them, so that
+# cataloguing a single image starts quickly
+deferred=[
+  'argparse', 'gzip', 'hashlib', 'json', 'mmap', 'multiprocessing',
+  'sqlite3', 'unittest', 'zipfile'
+]
+
+scenarios=[
+  ('40track_full', dict(tracks=40, sizes=filling(40, 31))),
+  ('80track_full', dict(tracks=80, sizes=filling(80, 31))),
+  ('tiny_files', dict(tracks=80, sizes=[1+(i*7)%50 for i in range(31)])),
+  ('cropped', dict(tracks=80, sizes=filling(40, 31), crop=True)),
+  ('oversize', dict(tracks=80, sizes=filling(80, 31), extra=b'\xaa'*1000)),
+  ('fragmented', dict(tracks=80, sizes=[sectorlen*11+5]*31, gap=13)),
+]
+
+def best_time(function, repeat, setup=None):
+    '''
+    Return the shortest time function took over repeat runs.  If setup is
+    given, it's called (untimed) before each run, and what it returns is
+    passed to function.
+    '''
+    best=None
+    for i in range(repeat):
+        arg=setup() if setup!=None else None
+        start=timeit.default_timer()
+        function(arg)
+        elapsed=timeit.default_timer()-start
+        if best==None or elapsed<best:
+            best=elapsed
+    return best
+
+def startup_time(image, repeat):
+    '''
+    Return the best time of repeat runs of the command line cataloguing
+    image, each in a new interpreter, from starting it to its exit
+    '''
+    script=os.path.splitext(os.path.abspath(dfstran.__file__))[0]+'.py'
+    with open(os.devnull,'w') as devnull:
+        return best_time(
+          lambda a:subprocess.check_call(
+            [sys.executable, script, '-c', image], stdout=devnull
+          ), repeat
+        )
+
+def run_scenario(name, layout, work, repeat):
+    '''
+    Time each operation on the scenario's image, using the folder work for
+    its files.  Returns a dict of operation names to times in seconds.
+    '''
+    image=os.path.join(work, name+'.ssd')
+    with open(image,'wb') as handle:
+        handle.write(SyntheticDisc(**layout).build_ssd())
+    results={}
+    counter=[0]
+    def new_dir(arg=None):
+        counter[0]+=1
+        return os.path.join(work, '{}.{}'.format(name, counter[0]))
+
+    results['startup']=startup_time(image, repeat)
+    d=dfstran.SsdDisc(image)
+    results['readcat']=best_time(lambda a:d.readcat(), repeat)
+    for v in range(4):
+        results['info{}'.format(v)]=best_time(lambda a:d.info(v), repeat)
+    results['write_as_files']=best_time(d.write_as_files, repeat, new_dir)
+    d.close()
+
+    unpacked=new_dir()
+    dfstran.SsdDisc(image).write_as_files(unpacked)
+    results['parse_dir']=best_time(
+      lambda a:dfstran.DirDisc(unpacked, 0), repeat
+    )
+    results['fit_files']=best_time(
+      lambda disc:disc.fit_files(), repeat,
+      lambda:dfstran.DirDisc(unpacked, 0)
+    )
+    results['write_as_ssd']=best_time(
+      lambda target:dfstran.DirDisc(unpacked, 0).write_as_ssd(target),
+      repeat, lambda:new_dir()+'.ssd'
+    )
+    return results
+
+def run(names=None, repeat=5):
+    '''
+    Run the named scenarios (or all of them), returning the results in the
+    form written as a baseline
+    '''
+    work=tempfile.mkdtemp(prefix='dfstran-bench-')
+    try:
+        results={}
+        for (name, layout) in scenarios:
+            if names==None or name in names:
+                results[name]=run_scenario(name, layout, work, repeat)
+    finally:
+        shutil.rmtree(work)
+    return {
+      'python': platform.python_version(),
+      'repeat': repeat,
+      'results': results
+    }
+
+def compare(baseline, current, tolerance):
+    '''
+    Yield a line comparing each time in current with baseline, and whether
+    it's slower by more than the tolerance (a ratio, e.g. 1.25)
+    '''
+    for name in sorted(current['results']):
+        for (op, seconds) in sorted(current['results'][name].items()):
+            old=baseline['results'].get(name, {}).get(op)
+            if old==None:
+                yield ('{} {}: {:.6f}s (new)'.format(name, op, seconds), False)
+            else:
+                ratio=seconds/old if old else 1.0
+                slower=ratio>tolerance
+                yield ('{} {}: {:.6f}s vs {:.6f}s ({:.2f}x){}'.format(
+                  name, op, seconds, old, ratio, ' SLOWER' if slower else ''
+                ), slower)
+
+if __name__ == '__main__':
+    pars=argparse.ArgumentParser(prog='benchmark', description='time dfstran over synthetic disc images')
+    pars.add_argument('scenario', nargs='*', help='The scenarios to run (default: all of {})'.format(', '.join([n for (n, l) in scenarios])))
+    pars.add_argument('--repeat', '-r', type=int, default=5, help='How many times to run each operation, taking the best time')
+    pars.add_argument('--output', '-o', help='Write the results as JSON to this file, e.g. to keep as a baseline')
+    pars.add_argument('--baseline', '-b', help='Compare the results with this earlier output, failing if any are slower')
+    pars.add_argument('--tolerance', '-t', type=float, default=1.25, help='How many times slower than the baseline counts as slower')
+    args=pars.parse_args()
+    for name in args.scenario:
+        if name not in [n for (n, l) in scenarios]:
+            pars.error("unknown scenario '{}'".format(name))
+
+    current=run(args.scenario or None, args.repeat)
+    if args.output:
+        with open(args.output,'w') as handle:
+            json.dump(current, handle, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline,'r') as handle:
+            baseline=json.load(handle)
+        failed=False
+        for (line, slower) in compare(baseline, current, args.tolerance):
+            print(line)
+            failed=failed or slower
+        exit(1 if failed else 0)
+    elif not args.output:
+        json.dump(current, sys.stdout, indent=1, sort_keys=True)
+        print()
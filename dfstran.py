@@ -3,26 +3,328 @@
 from __future__ import print_function
 import os
 import os.path
-import argparse
-
-import unittest
+import binascii
+import bisect
+import collections
+import contextlib
+import functools
+import io
+import struct
+import sys
+import threading
+import time
+
+# Modules only needed by some commands (archives, pools, the index and so
+# on) are imported where they're used, so cataloguing a single image starts
+# quickly.  The tests are in test_dfstran.py.
 
 sectorlen=2**8
+tracksectors=10 # Sectors per track, for double-sided images
+tracklen=tracksectors*sectorlen
+
+try:
+    text_type=unicode
+except NameError:
+    text_type=str # Python 3
 
-class DfsFile(object):
+def to_bytes(data):
     '''
-    DfsFile represents one file on a DFS disc
+    Return data as a bytes-like object.  Disc data gets passed around as
+    Latin-1 strings, lists of byte values (or characters), and buffers like
+    memoryviews, so this reconciles them for writing or inspecting bytes.
+    '''
+    if isinstance(data, list):
+        return bytearray([c if isinstance(c, int) else ord(c) for c in data])
+    if isinstance(data, text_type):
+        return data.encode('Latin1')
+    return data
+
+def to_hex(data):
+    '''
+    Return the bytes in data as a string of lower case hex digit pairs
+    '''
+    return to_str(binascii.hexlify(to_bytes(data)))
+
+def to_str(data):
+    '''
+    Return data as a native string with one character per byte, as used for
+    names and titles.
+    '''
+    if isinstance(data, str):
+        return data
+    data=bytes(bytearray(to_bytes(data)))
+    if str is bytes:
+        return data # Python 2
+    return data.decode('Latin1')
+
+class CountingFile(object):
+    '''
+    Wraps an open file, counting the calls made on it and the bytes moved
+    in the Stats given
+    '''
+    def __init__(self, handle, stats):
+        self.handle=handle
+        self.stats=stats
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.handle.close()
+
+    def __iter__(self):
+        return iter(self.readlines())
+
+    def read(self, *size):
+        data=self.handle.read(*size)
+        self.stats.count(reads=1, bytes_read=len(data))
+        return data
+
+    def readinto(self, buffer):
+        count=self.handle.readinto(buffer)
+        self.stats.count(reads=1, bytes_read=count or 0)
+        return count
+
+    def readlines(self):
+        lines=self.handle.readlines()
+        self.stats.count(reads=1, bytes_read=sum([len(l) for l in lines]))
+        return lines
+
+    def write(self, data):
+        self.stats.count(writes=1, bytes_written=len(data))
+        return self.handle.write(data)
+
+    def seek(self, *args):
+        self.stats.count(seeks=1)
+        return self.handle.seek(*args)
+
+class Stats(object):
+    '''
+    Counts of the file I/O done, and the time spent in each phase of the
+    work, for --stats.  Files are only counted if they're opened through
+    open() while enabled.  Phases nest, with the time spent in an inner
+    phase not counted in the outer one.  I/O is counted from any thread,
+    but phases are only timed on the main thread.
     '''
+    counters=['files_opened','seeks','reads','writes','bytes_read','bytes_written']
+
     def __init__(self):
-        self.name=None
-        self.dir=None
-        self.loc=None
-        self.load_address=0x001900
-        self.exec_address=0x001900
-        self.loc=False
-        self.start_sector=2
-        self.len=None
-        self.catnum=None
+        self.enabled=False
+        self.lock=threading.Lock()
+        self.thread=threading.current_thread()
+        self.reset()
+
+    def count(self, **counts):
+        '''
+        Add to the named counters
+        '''
+        with self.lock:
+            for (counter, n) in counts.items():
+                setattr(self, counter, getattr(self, counter)+n)
+
+    def reset(self):
+        for c in self.counters:
+            setattr(self, c, 0)
+        self.phases=collections.OrderedDict()
+        self.stack=[]
+        self.since=None
+
+    def open(self, path, mode='r'):
+        '''
+        Open a file like open() does, counting what's done with it if enabled
+        '''
+        if 'b' in mode:
+            handle=io.open(path, mode)
+        else:
+            handle=open(path, mode)
+        if not self.enabled:
+            return handle
+        self.count(files_opened=1)
+        return CountingFile(handle, self)
+
+    def __charge(self, now):
+        if self.stack:
+            self.phases[self.stack[-1]]=(
+              self.phases.get(self.stack[-1], 0)+now-self.since
+            )
+        self.since=now
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Time the code run within this context as the named phase
+        '''
+        if not self.enabled or threading.current_thread() is not self.thread:
+            yield
+            return
+        self.__charge(time.time())
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.__charge(time.time())
+            self.stack.pop()
+
+    def timed(self, name):
+        '''
+        Decorate a function so each call is timed as the named phase
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        '''
+        Return the counts and phase times as text, a line each
+        '''
+        lines=['{}: {}'.format(c.replace('_',' ').capitalize(), getattr(self, c))
+          for c in self.counters]
+        for (name, seconds) in self.phases.items():
+            lines.append('Phase {}: {:.6f}s'.format(name, seconds))
+        return '\n'.join(lines)+'\n'
+
+stats=Stats()
+
+def clear_dir(dir, remove=False):
+    '''
+    Delete everything in dir, and dir itself if remove is True
+    '''
+    import shutil
+    if remove:
+        shutil.rmtree(dir)
+        return
+    for name in os.listdir(dir):
+        path=os.path.join(dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+def write_json(handle, records, **fields):
+    '''
+    Write each of the records (dicts, like those from a disc's
+    iter_records()) to handle as a line of JSON, as it's generated, adding
+    the fields given to each
+    '''
+    import json
+    options={}
+    if str is bytes:
+        options['encoding']='Latin1' # Python 2's names are Latin-1 bytes
+    for record in records:
+        record.update(fields)
+        handle.write(json.dumps(record, **options)+'\n')
+
+def split_member(path):
+    '''
+    Split a path to a zip archive member, like bundle.zip:Games/Elite.ssd,
+    into the archive's path and the member's name.  Other paths come back
+    with None for the member.
+    '''
+    i=path.lower().find('.zip:')
+    if i<0:
+        return (path, None)
+    return (path[:i+4], path[i+5:])
+
+def is_image_name(name):
+    '''
+    Report whether name looks like a disc image, compressed or not
+    '''
+    return name.lower().endswith(('.ssd', '.dsd', '.ssd.gz', '.dsd.gz'))
+
+def image_stem(path):
+    '''
+    Return path without its image extensions, and with any zip archive
+    member turned into a folder named after the archive, for naming the
+    directory the image unpacks into
+    '''
+    (archive, member)=split_member(path)
+    if member!=None:
+        parts=member.replace('\\', '/').split('/')
+        if member[:1] in ('/', '\\') or os.path.splitdrive(member)[0] or \
+          '..' in parts:
+            raise ValueError(
+              "Archive member {} is absolute or contains '..'".format(member)
+            )
+        path=os.path.join(os.path.splitext(archive)[0], *parts)
+    if path.lower().endswith('.gz'):
+        path=path[:-3]
+    return os.path.splitext(path)[0]
+
+class ArchiveCache(object):
+    '''
+    Reads disc images out of zip archives and gzip files into memory.  The
+    last zip archive used is kept open, so reading many images from one
+    archive only opens and indexes it once.
+    '''
+    def __init__(self):
+        self.key=None
+        self.archive=None
+
+    def open(self, path):
+        '''
+        Return the open zip archive at path
+        '''
+        stat=os.stat(path)
+        key=(os.path.abspath(path), stat.st_mtime, stat.st_size)
+        if key!=self.key:
+            import zipfile
+            self.close()
+            self.archive=zipfile.ZipFile(path)
+            self.key=key
+        return self.archive
+
+    def close(self):
+        if self.archive!=None:
+            self.archive.close()
+        self.archive=None
+        self.key=None
+
+    def read(self, path):
+        '''
+        Return the decompressed contents of the archive member or gzip file
+        at path, or None if it's a plain file
+        '''
+        (archive, member)=split_member(path)
+        data=None
+        if member!=None:
+            data=self.open(archive).read(member)
+        if path.lower().endswith('.gz'):
+            import gzip
+            if data==None:
+                handle=gzip.open(path,'rb')
+            else:
+                handle=gzip.GzipFile(fileobj=io.BytesIO(data))
+            try:
+                data=handle.read()
+            finally:
+                handle.close()
+        return data
+
+    def images(self, path):
+        '''
+        Yield the paths of the disc images in the zip archive at path
+        '''
+        for name in sorted(self.open(path).namelist()):
+            if is_image_name(name):
+                yield path+':'+name
+
+archives=ArchiveCache()
+
+class CatalogueEntry(object):
+    '''
+    The operations on one file on a DFS disc, given its name, dir, loc,
+    load_address, exec_address, len, start_sector and catnum.  It has no
+    instance dictionary, so subclasses can define __slots__ to keep their
+    objects small.
+    '''
+    __slots__=()
 
     def read(self):
         pass
@@ -30,24 +332,73 @@ class DfsFile(object):
     def read_after(self):
         pass
 
-    def write_as_file(self, dir):
-        filename_inf=open(os.path.join(dir,'.{}.{}.inf'.format(self.dir,self.name)),'w')
-        filename_inf.write('{}.{}, '.format(self.dir, self.name))
-        filename_inf.write('L:{:06X}, '.format(self.load_address))
-        filename_inf.write('E:{:06X} '.format(self.exec_address))
-        filename_inf.write('F:{}\n'.format('L' if self.loc else ''))
-        filename_inf.close()
-        filename_inf2=open(os.path.join(dir,'.{}.{}.inf2'.format(self.dir,self.name)),'w')
-        filename_inf2.write('Start sector:{:03x}\n'.format(self.start_sector))
-        filename_inf2.write('Length:{}\n'.format(self.len))
-        filename_inf2.write('Catalogue index:{}\n'.format(self.catnum))
-        filename_inf2.write('After:')
-        for c in self.read_after():
-            filename_inf2.write('{:02x}'.format(ord(c)))
-        filename_inf2.close()
-        filout=open(os.path.join(dir, '{}.{}'.format(self.dir, self.name)), 'wb')
-        filout.write(self.read())
-        filout.close()
+    @stats.timed('file extraction')
+    def write_as_file(self, dir, store=None):
+        '''
+        Write the file and its .inf and .inf2 files into dir.  If a BlobStore
+        is given, the file's contents are kept in it, and linked into dir.
+        '''
+        self.write_inf(dir)
+        target=os.path.join(dir, '{}.{}'.format(self.dir, self.name))
+        if store!=None:
+            store.link(store.put(self.read()), target)
+        else:
+            data=to_bytes(self.read()) # Before opening, so a failure leaks nothing
+            with stats.open(target, 'wb') as filout:
+                filout.write(data)
+
+    @stats.timed('sidecar writing')
+    def write_inf(self, dir):
+        '''
+        Write the file's .inf and .inf2 files into dir
+        '''
+        with stats.open(os.path.join(dir,'.{}.{}.inf'.format(self.dir,self.name)),'w') as filename_inf:
+            filename_inf.write(
+              '{}.{}, L:{:06X}, E:{:06X} F:{}\n'.format(
+                self.dir, self.name, self.load_address, self.exec_address,
+                'L' if self.loc else ''
+              )
+            )
+        with stats.open(os.path.join(dir,'.{}.{}.inf2'.format(self.dir,self.name)),'w') as filename_inf2:
+            filename_inf2.write(
+              'Start sector:{:03x}\nLength:{}\nCatalogue index:{}\nAfter:{}'.format(
+                self.start_sector, self.len, self.catnum,
+                to_hex(self.read_after())
+              )
+            )
+
+    def read_into(self, buffer):
+        '''
+        Copy the file's data into buffer, which is as long as the file
+        '''
+        data=to_bytes(self.read())[:len(buffer)]
+        buffer[:len(data)]=data
+
+    def get_cat_data(self):
+        '''
+        Get the 8 bytes of data that go into sector 0 for every file on a disc
+        '''
+        block='{:<7s}'.format(self.name)[:7]
+        dirflag=ord(self.dir[0])
+        if self.loc:
+            dirflag=dirflag | 0x80
+        block+=chr(dirflag)
+        return to_bytes(block)
+
+    def get_attrib_data(self):
+        '''
+        Get the 8 bytes of data that go into sector 1 for every file on a disc
+        '''
+        return struct.pack('<HHHBB',
+          self.load_address & 0x00ffff,
+          self.exec_address & 0x00ffff,
+          self.len & 0x00ffff,
+          ((self.exec_address & 0x030000) >> 10) + # 0b11000000
+          ((self.len & 0x030000) >> 12) +  # 0b00110000
+          ((self.load_address & 0x030000) >> 14) + # 0b00001100
+          ((self.start_sector & 0x0300) >> 8), # 0b00000011
+          self.start_sector & 0x0000ff
+        )
 
     def info(self):
         '''
@@ -59,40 +410,192 @@ class DfsFile(object):
     def __str__(self):
         return self.info()
 
-class TestDfsFile(unittest.TestCase):
-    def setUp(self):
-        self.f=DfsFile()
-        self.f.dir='T'
-        self.f.name='estfile'
-        self.f.loc=True
-        self.f.load_address=0x1000
-        self.f.exec_address=0x1100
-        self.f.len=0x1d0
-        self.f.catnum=2
-        self.f.start_sector=0x040
-        self.f.read=lambda:'Pass'.encode(encoding='Latin_1')
-        self.f.read_after=lambda:['\xde','\xad','\xbe','\xef']
-
-    def test_info(self):
-        self.assertEqual(self.f.info(),'T.estfile L 001000 001100 0001D0 040')
-
-    def test_write_as_file(self):
-        self.assertEqual(os.mkdir(os.path.join('test_data','test_out')), None)
+class DfsFile(CatalogueEntry):
+    '''
+    DfsFile represents one file on a DFS disc
+    '''
+    def __init__(self):
+        self.name=None
+        self.dir=None
+        self.loc=None
+        self.load_address=0x001900
+        self.exec_address=0x001900
+        self.loc=False
+        self.start_sector=2
+        self.len=None
+        self.catnum=None
+
+class BlobStore(object):
+    '''
+    A content-addressed store of file contents, shared by many unpacked
+    discs.  Each distinct file is kept once, named by its SHA-1 hash, and
+    linked into each disc's directory.  Blobs are made read-only, so the
+    shared copy can't be changed by editing one disc's file in place.
+    '''
+    def __init__(self, root):
+        self.root=root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def put(self, data):
+        '''
+        Store data, unless it's already there, and return its hash
+        '''
+        import hashlib
+        data=to_bytes(data)
+        digest=hashlib.sha1(data).hexdigest()
+        path=self.path(digest)
+        if not os.path.isfile(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass # Made by another process in the meantime
+            # Write under a private name first, so other processes never
+            # see a partly written blob
+            temp='{}.{}.{}.tmp'.format(
+              path, os.getpid(), threading.current_thread().ident
+            )
+            with stats.open(temp,'wb') as handle:
+                handle.write(data)
+            os.chmod(temp, 0o444)
+            try:
+                os.rename(temp, path)
+            except OSError:
+                os.unlink(temp) # Stored by another process in the meantime
+        return digest
+
+    def link(self, digest, target):
+        '''
+        Make target refer to the blob with the given hash, copying it if it
+        can't be hard linked
+        '''
         try:
-            self.f.write_as_file(os.path.join('test_data','test_out'))
-            with open(os.path.join('test_data','test_out','.T.estfile.inf')) as f:
-                self.assertEqual(f.read(),'T.estfile, L:001000, E:001100 F:L\n')
-            self.assertEqual(os.unlink(os.path.join('test_data','test_out','.T.estfile.inf')), None)
-            with open(os.path.join('test_data','test_out','.T.estfile.inf2')) as f:
-                self.assertEqual(f.read(),'Start sector:040\nLength:464\nCatalogue index:2\nAfter:deadbeef')
-            self.assertEqual(os.unlink(os.path.join('test_data','test_out','.T.estfile.inf2')), None)
-            with open(os.path.join('test_data','test_out','T.estfile')) as f:
-                self.assertEqual(f.read(),'Pass')
-            self.assertEqual(os.unlink(os.path.join('test_data','test_out','T.estfile')), None)
-        finally:
-            for f in os.listdir(os.path.join('test_data','test_out')):
-                os.unlink(os.path.join('test_data','test_out',f))
-            os.rmdir(os.path.join('test_data','test_out'))
+            os.link(self.path(digest), target)
+        except (AttributeError, OSError):
+            import shutil
+            shutil.copyfile(self.path(digest), target)
+
+class SectorMap(object):
+    '''
+    Allocation map of the sectors on a disc, holding a byte per sector which
+    is non-zero if the sector's in use.  Sectors past the end of the map
+    count as in use.
+
+    Alongside the map it keeps an index of the free extents (runs of free
+    sectors), ordered by length, so a hole for a file can be found with a
+    binary search rather than by trying every start sector.
+    '''
+    def __init__(self, sectors, used=False):
+        self.map=bytearray(b'\1'*sectors if used else sectors)
+        self.__rebuild()
+
+    def __len__(self):
+        return len(self.map)
+
+    def resize(self, sectors, used=False):
+        '''
+        Grow (or shrink) the map to the given number of sectors, with any
+        new sectors marked free unless used is True
+        '''
+        if sectors>len(self.map):
+            self.map+=b'\1'*(sectors-len(self.map)) if used else bytearray(
+              sectors-len(self.map)
+            )
+        else:
+            del self.map[sectors:]
+        self.__rebuild()
+
+    def is_free(self, sector):
+        return 0<=sector<len(self.map) and not self.map[sector]
+
+    def allocate(self, start, count=1):
+        '''
+        Mark count sectors from start as in use
+        '''
+        self.__fill(start, count, b'\1')
+
+    def release(self, start, count=1):
+        '''
+        Mark count sectors from start as free
+        '''
+        self.__fill(start, count, b'\0')
+
+    def find_free_run(self, count, accept=None):
+        '''
+        Return the sector on which the smallest run of at least count free
+        sectors begins (the lowest, if there are several the same size), or
+        None if there's no such run.  If accept is given, runs whose start
+        it returns False for are passed over for the next smallest.
+        '''
+        i=bisect.bisect_left(self.__sizes, (count, -1))
+        while i<len(self.__sizes):
+            start=self.__sizes[i][1]
+            if accept==None or accept(start):
+                return start
+            i+=1
+        return None
+
+    def free_extents(self):
+        '''
+        Return a list of (start sector, length) pairs for each run of free
+        sectors, in order
+        '''
+        return [(s, self.__lengths[s]) for s in self.__starts]
+
+    def unused(self):
+        '''
+        Return a list of the free sectors, in order
+        '''
+        s=[]
+        for start in self.__starts:
+            s.extend(range(start, start+self.__lengths[start]))
+        return s
+
+    def __fill(self, start, count, value):
+        end=min(start+count, len(self.map))
+        start=max(start, 0)
+        if end>start:
+            self.map[start:end]=value*(end-start)
+            self.__reindex(start, end)
+
+    def __rebuild(self):
+        self.__starts=[]
+        self.__lengths=dict()
+        self.__sizes=[]
+        self.__reindex(0, len(self.map))
+
+    def __reindex(self, start, end):
+        '''
+        Update the free extent index after sectors start to end have changed
+        '''
+        # Widen the range to take in free extents running into it
+        if start>0 and not self.map[start-1]:
+            start=self.map.rfind(b'\1', 0, start)+1
+        if end<len(self.map) and not self.map[end]:
+            end=self.map.find(b'\1', end)
+            if end<0:
+                end=len(self.map)
+        # Forget the extents there
+        i=bisect.bisect_left(self.__starts, start)
+        j=bisect.bisect_left(self.__starts, end)
+        for s in self.__starts[i:j]:
+            del self.__sizes[
+              bisect.bisect_left(self.__sizes, (self.__lengths.pop(s), s))
+            ]
+        # And find them again
+        found=[]
+        s=self.map.find(b'\0', start, end)
+        while s>=0:
+            e=self.map.find(b'\1', s, end)
+            if e<0:
+                e=end
+            found.append(s)
+            self.__lengths[s]=e-s
+            bisect.insort(self.__sizes, (e-s, s))
+            s=self.map.find(b'\0', e, end)
+        self.__starts[i:j]=found
 
 class DfsDisc(object):
     def __init__(self):
@@ -103,6 +606,7 @@ class DfsDisc(object):
         self.ssd_size=None
         self.cat=[]
         self.additional=None
+        self.sector_map=None
 
     def list_catalogue(self):
         '''
@@ -138,78 +642,353 @@ class DfsDisc(object):
         '''
         pass
 
+    def catalogue_sectors(self):
+        '''
+        Return the contents of sectors 0 and 1, as built from the disc's
+        details and its catalogue
+        '''
+        if len(self.cat)>31:
+            raise RuntimeError(
+              'Too many files ({}) for a DFS catalogue'.format(len(self.cat))
+            )
+        title=to_bytes('{:12s}'.format(self.title or '')[:12])
+        room=sectorlen-8-len(self.cat)*8
+        unused=[]
+        for u in self.read_unused_catalogue():
+            u=bytes(bytearray(to_bytes(u or b'')))
+            # Keep the data where it was, at the end of the sector
+            if len(u)>=room:
+                unused.append(u[len(u)-room:])
+            else:
+                unused.append(b'\0'*(room-len(u))+u)
+        names=bytearray(title[0:8])
+        attribs=bytearray(title[8:12])+struct.pack('BBBB',
+          (self.serial_no or 0) & 0xff,
+          len(self.cat)*8,
+          (((self.boot_options or 0) & 0x0f) << 4)+((self.sectors >> 8) & 0x07),
+          self.sectors & 0xff
+        )
+        for f in self.cat:
+            names+=f.get_cat_data()
+            attribs+=f.get_attrib_data()
+        return [bytes(names+unused[0]), bytes(attribs+unused[1])]
+
+    def build_ssd(self):
+        '''
+        Assemble the whole disc image in a single buffer, which is returned
+        as a bytearray
+        '''
+        additional=to_bytes(self.read_additional() or b'')
+        size=self.sectors*sectorlen
+        image=bytearray(size+len(additional))
+        def put(offset, data):
+            data=to_bytes(data)[:max(0, len(image)-offset)]
+            image[offset:offset+len(data)]=data
+
+        (sector0, sector1)=self.catalogue_sectors()
+        put(0, sector0)
+        put(sectorlen, sector1)
+        for s in self.list_unused_sectors():
+            if s<self.sectors:
+                put(s*sectorlen, self.read_sector(s))
+        for f in self.cat:
+            offset=f.start_sector*sectorlen
+            length=max(0, min(f.len, size-offset))
+            view=memoryview(image)
+            f.read_into(view[offset:offset+length])
+            del view # Release the buffer, so it can be resized later
+            put(offset+f.len, to_bytes(f.read_after())[:max(0, size-offset-f.len)])
+        put(size, additional)
+        if self.ssd_size!=None and self.ssd_size<size:
+            # Disc image was cropped
+            del image[self.ssd_size:]
+        return image
+
+    @stats.timed('packing')
     def write_as_ssd(self, filename):
-        pass #TODO
+        image=self.build_ssd()
+        with stats.open(filename,'wb') as handle:
+            handle.write(image)
 
-    def write_as_files(self, dir):
+    @stats.timed('sidecar writing')
+    def write_as_files(self, dir, store=None, threads=None):
+        '''
+        Unpack the disc into dir, which must be empty or not yet exist.  If
+        a BlobStore is given, the files' contents are kept in it, and linked
+        into dir.  If threads is given, that many files are written at once
+        by a pool of threads.  If anything fails, dir is left empty (or
+        removed, if it was made for the disc).
+        '''
         if os.path.isdir(dir):
             if os.listdir(dir):
                 raise RuntimeError('Directory {} exists and is not empty'.format(dir))
+            created=False
         else:
             if os.path.isfile(dir):
                 raise RuntimeError('{} is an existing file; please provide a name for a directory into which the disc can be unpacked'.format(dir))
             else:
                 os.makedirs(dir)
-        disk_inf=open(os.path.join(dir,'..THIS_DISK.inf'),'w')
-        disk_inf.write('*OPT4,{}\n'.format(self.boot_options))
-        disk_inf.write('T: {}, S: {}\n'.format(self.title, self.serial_no))
-        disk_inf.close()
-        disk_inf2=open(os.path.join(dir,'..THIS_DISK.inf2'),'w')
-        disk_inf2.write('Sectors:{:03x}, '.format(self.sectors))
-        disk_inf2.write('SSD file size:{}, '.format(self.ssd_size))
-        disk_inf2.write('Catalogue len:{}\n'.format(len(self.cat)))
-        disk_inf2.close()
+                created=True
+        try:
+            self.write_disc_files(dir, store, threads)
+        except BaseException:
+            clear_dir(dir, created)
+            raise
+
+    def write_disc_files(self, dir, store=None, threads=None):
+        '''
+        Write the disc's files, and the files describing the rest of the disc,
+        into dir
+        '''
+        with stats.open(os.path.join(dir,'..THIS_DISK.inf'),'w') as disk_inf:
+            disk_inf.write('*OPT4,{}\nT: {}, S: {}\n'.format(
+              self.boot_options, self.title, self.serial_no
+            ))
+        with stats.open(os.path.join(dir,'..THIS_DISK.inf2'),'w') as disk_inf2:
+            disk_inf2.write(
+              'Sectors:{:03x}, SSD file size:{}, Catalogue len:{}\n'.format(
+                self.sectors, self.ssd_size, len(self.cat)
+              )
+            )
         after_cat=self.read_unused_catalogue()
-        empty_inf=open(os.path.join(dir,'..Empty.inf'),'w')
-        empty_inf.write('After sector 000:')
-        for c in after_cat[0]:
-            empty_inf.write('{:02x}'.format(ord(c)))
-        empty_inf.write('\n')
-        empty_inf.write('After sector 001:')
-        for c in after_cat[1]:
-            empty_inf.write('{:02x}'.format(ord(c)))
-        empty_inf.write('\n')
+        lines=[
+          'After sector 000:'+to_hex(after_cat[0]),
+          'After sector 001:'+to_hex(after_cat[1])
+        ]
         for i in self.list_unused_sectors():
-            empty_inf.write('Sector {:03X}:'.format(i))
-            for c in self.read_sector(i):
-                empty_inf.write('{:02x}'.format(ord(c)))
-            empty_inf.write('\n')
-        empty_inf.write('After disc image:')
-        for c in self.read_additional():
-            empty_inf.write('{:02x}'.format(ord(c)))
-        empty_inf.write('\n')
-        empty_inf.close()
-        for fil in self.cat:
-            fil.write_as_file(dir)
+            lines.append('Sector {:03X}:'.format(i)+to_hex(self.read_sector(i)))
+        lines.append('After disc image:'+to_hex(self.read_additional()))
+        lines.append('')
+        with stats.open(os.path.join(dir,'..Empty.inf'),'w') as empty_inf:
+            empty_inf.write('\n'.join(lines))
+        if threads and threads>1 and len(self.cat)>1:
+            import multiprocessing.pool
+            pool=multiprocessing.pool.ThreadPool(min(threads, len(self.cat)))
+            try:
+                with stats.phase('file extraction'):
+                    # Waits for every file, then raises the first failure
+                    pool.map(lambda fil:fil.write_as_file(dir, store), self.cat)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for fil in self.cat:
+                fil.write_as_file(dir, store)
 
     def write_as_adfs(self, dir):
         pass #TODO
 
-class SsdFile(DfsFile):
-    def __init__(self, ssddisc, catnum):
-        self.ssddisc=ssddisc
-        super(SsdFile, self).__init__()
-        self.readcat(catnum)
+    def output_bin(self, heading, data):
+        hexdata=to_hex(data)
+        r=heading+' '*((0-len(heading.split('\n')[-1])) % 5)
+        if len(hexdata)==0:
+            return r+'None'
+        pairs=len(hexdata)//4*4
+        return r+''.join(
+          [hexdata[i:i+4]+' ' for i in range(0, pairs, 4)]
+        )+hexdata[pairs:]
+
+    @stats.timed('info rendering')
+    def info(self, verbose):
+        return ''.join(self.iter_info(verbose))
+
+    @stats.timed('info rendering')
+    def write_info(self, handle, verbose):
+        '''
+        Write the output of info() to the file object handle as it's
+        generated, rather than building it all up first
+        '''
+        for r in self.iter_info(verbose):
+            handle.write(r)
+
+    def iter_info(self, verbose):
+        '''
+        Generate the text of info() a piece at a time
+        '''
+        if verbose:
+            r='Title: {}\nSerial no:{}\n'
+        else:
+            r='{} ({})\n'
+        yield r.format(self.title,self.serial_no)
+        if verbose:
+            k=self.sectors*sectorlen/1024
+            yield 'Total sectors:0x{:03x} ({}K)\n'.format(
+              self.sectors, int(k) if int(k) == k else k # Tidy py3 fractions
+            )
+        if verbose>1:
+            if self.ssd_size != self.sectors * sectorlen:
+                yield 'INFO: Actual size 0x{:03x} sectors{}\n'.format(
+                  self.ssd_size//sectorlen,
+                  ' with {} extra byte(s)'.format(self.ssd_size % sectorlen)
+                    if self.ssd_size % sectorlen != 0 else ''
+                )
+        opt4=['off','LOAD','RUN','EXEC']+['invalid']*12
+        yield 'Option {} ({})\n'.format(
+          self.boot_options, opt4[self.boot_options]
+        )
+        cat=self.cat
+        if not verbose:
+            cat=sorted(cat,key=lambda fil:fil.dir+'.'+fil.name)
+        i=0
+        for f in cat:
+            if verbose:
+                yield 'File {}: {}{}\n'.format(
+                  i+1, f.info(),
+                  ' cropped!'
+                    if f.start_sector*sectorlen+f.len > self.ssd_size
+                    else
+                  ''
+                )
+                if verbose>2:
+                    yield self.output_bin('Additional data: ', f.read_after())+'\n'
+            else:
+                yield f.info()+'\n'
+            i+=1
+        if verbose>2:
+            u=self.read_unused_catalogue()
+            yield self.output_bin('Unused in sector 0x000: ', u[0])+'\n'
+            yield self.output_bin('Unused in sector 0x001: ' ,u[1])+'\n'
+        if verbose>1:
+            u=self.list_unused_sectors()
+            if len(u)==0:
+                yield 'All sectors are in use'
+            else:
+                yield 'Unused sectors:'
+                for s in u:
+                    if (s*sectorlen) >= self.ssd_size:
+                        break
+                    if verbose>2:
+                        yield self.output_bin(
+                          '\n- Sector 0x{:03x}: '.format(s),
+                          self.read_sector(s)
+                        )
+                    else:
+                        yield '0x{:03x} '.format(s)
+                if self.sectors > self.ssd_size//sectorlen:
+                    # More sectors declared than are in the file
+                    if self.ssd_size//sectorlen == self.sectors-1:
+                        yield '\nSector 0x{:03x} cropped'.format(self.sectors-1)
+                    else:
+                        yield '\nSectors 0x{:03x}-0x{:03x} cropped'.format(
+                          self.ssd_size//sectorlen, self.sectors-1
+                        )
+            yield '\n'
+        if verbose>2:
+            a=self.read_additional()
+            if a:
+                yield self.output_bin('Data after disc image: ',a)+'\n'
+            else:
+                yield 'No data after disc image\n'
+
+    def iter_records(self, files=False):
+        '''
+        Generate a dict describing the disc, with what info() reports about
+        its size and unused sectors, followed by one for each file if files
+        is True.  These are what write_json() writes.
+        '''
+        opt4=['off','LOAD','RUN','EXEC']+['invalid']*12
+        size=self.ssd_size
+        if size==None:
+            size=self.sectors*sectorlen
+        yield collections.OrderedDict([
+          ('record', 'disc'),
+          ('title', self.title),
+          ('serial_no', self.serial_no),
+          ('sectors', self.sectors),
+          ('boot_options', self.boot_options),
+          ('boot', opt4[self.boot_options]),
+          ('size', size),
+          ('files', len(self.cat)),
+          ('cropped_sectors', max(0, self.sectors-size//sectorlen)),
+          ('extra_bytes', max(0, size-self.sectors*sectorlen)),
+          ('unused_sectors', [s for s in self.list_unused_sectors()
+            if s*sectorlen<size])
+        ])
+        if files:
+            for f in self.cat:
+                yield collections.OrderedDict([
+                  ('record', 'file'),
+                  ('catnum', f.catnum),
+                  ('dir', f.dir),
+                  ('name', f.name),
+                  ('locked', bool(f.loc)),
+                  ('load_address', f.load_address),
+                  ('exec_address', f.exec_address),
+                  ('length', f.len),
+                  ('start_sector', f.start_sector),
+                  ('cropped', f.start_sector*sectorlen+f.len>size)
+                ])
+
+def decoded(function):
+    '''
+    Make function into a read-only property that calls it on first access,
+    then keeps the value in the slot named after it with a leading
+    underscore, for later accesses
+    '''
+    slot='_'+function.__name__
+    def get(self):
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            value=function(self)
+            setattr(self, slot, value)
+            return value
+    return property(get, doc=function.__doc__)
+
+class SsdFile(CatalogueEntry):
+    '''
+    A file in an ssd image's catalogue.  The raw 16 bytes of its catalogue
+    entry (8 from sector 0, then 8 from sector 1) are kept, and each detail
+    is decoded from them the first time it's asked for, so a catalogue
+    takes little memory and listing names doesn't decode addresses.
+    '''
+    __slots__=('ssddisc', 'catnum', 'record', '_name', '_dir', '_loc',
+      '_load_address', '_exec_address', '_len', '_start_sector')
 
-    def readcat(self, catnum):
+    def __init__(self, ssddisc, catnum, record):
+        self.ssddisc=ssddisc
         self.catnum=catnum
-        nameblock=self.ssddisc.read_sector(0)[catnum*8+8:catnum*8+16]
-        attribblock=self.ssddisc.read_sector(1)[catnum*8+8:catnum*8+16]
-        self.dir=chr(ord(nameblock[-1]) & 0x7f)
-        self.loc=(ord(nameblock[-1]) & 0x80) >> 7
-        self.name=nameblock[0:7].rstrip()
-        load_address=ord(attribblock[0]) + (ord(attribblock[1]) << 8)
-        exec_address=ord(attribblock[2]) + (ord(attribblock[3]) << 8)
-        self.len=ord(attribblock[4]) + (ord(attribblock[5]) << 8) + ((ord(attribblock[6]) & 0x30) << 12)
-        self.start_sector=ord(attribblock[7]) + ((ord(attribblock[6]) & 0x03) << 8)
-        exec_extra=(ord(attribblock[6]) & 0xc0) >> 6
-        if exec_extra==0x03:
-          exec_extra=0xff
-        self.exec_address=exec_address+(exec_extra<<16)
-        load_extra=(ord(attribblock[6]) & 0x0c) >> 2
-        if load_extra==0x03:
-          load_extra=0xff
-        self.load_address=load_address+(load_extra<<16)
+        self.record=bytes(record)
+
+    @staticmethod
+    def extend(address, extra):
+        '''
+        Add the two extra address bits to a 16-bit address, where 11 means
+        the I/O processor's FFxxxx addresses
+        '''
+        return address+((0xff if extra==0x03 else extra)<<16)
+
+    @decoded
+    def name(self):
+        return to_str(self.record[0:7]).rstrip()
+
+    @decoded
+    def dir(self):
+        return chr(bytearray(self.record[7:8])[0] & 0x7f)
+
+    @decoded
+    def loc(self):
+        return (bytearray(self.record[7:8])[0] & 0x80) >> 7
+
+    @decoded
+    def load_address(self):
+        (address, extra)=struct.unpack_from('<H4xB', self.record, 8)
+        return self.extend(address, (extra & 0x0c) >> 2)
+
+    @decoded
+    def exec_address(self):
+        (address, extra)=struct.unpack_from('<H2xB', self.record, 10)
+        return self.extend(address, (extra & 0xc0) >> 6)
+
+    @decoded
+    def len(self):
+        (length, extra)=struct.unpack_from('<HB', self.record, 12)
+        return length+((extra & 0x30) << 12)
+
+    @decoded
+    def start_sector(self):
+        (extra, start)=struct.unpack_from('<BB', self.record, 14)
+        return start+((extra & 0x03) << 8)
 
     def read(self):
         return self.ssddisc.read(self.start_sector, self.len)
@@ -221,187 +1000,631 @@ class SsdFile(DfsFile):
         return sectordata[self.len % sectorlen:]
 
 class SsdDisc(DfsDisc):
-    def __init__(self, filename):
+    def __init__(self, filename, mapped=False):
         super(SsdDisc, self).__init__()
-        self.file=open(filename,'rb')
+        self.mapping=None
+        self.image=None
+        self.lock=threading.Lock()
+        data=archives.read(filename)
+        if data!=None:
+            # Already decompressed into memory, so serve it like a mapping
+            self.file=io.BytesIO(data)
+            self.image=memoryview(data)
+        else:
+            self.file=stats.open(filename,'rb')
+            if mapped:
+                self.map()
         self.readcat()
 
     def __del__(self):
+        self.close()
+
+    def map(self):
+        '''
+        Map the disc image into memory.  From then on reads return memoryview
+        slices of the mapping rather than each seeking, reading and decoding
+        its own copy of the data.
+        '''
+        import mmap
+        try:
+            self.mapping=mmap.mmap(
+              self.file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        except ValueError:
+            # Empty files can't be mapped
+            self.image=memoryview(b'')
+            return
+        try:
+            self.image=memoryview(self.mapping)
+        except TypeError:
+            # Python 2's mmap doesn't support memoryviews; settle for a copy
+            self.image=memoryview(self.mapping[:])
+
+    def load(self):
+        '''
+        Read the whole disc image into memory in one sequential pass, and
+        serve later reads from there, as when it's mapped, rather than each
+        seeking to its own part of the file
+        '''
+        if self.image is None:
+            with self.lock:
+                self.file.seek(0)
+                self.image=memoryview(self.file.read())
+
+    def close(self):
+        self.image=None
+        if getattr(self, 'mapping', None) is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                pass # Slices still in use; the mapping closes once they go
+            self.mapping=None
         if hasattr(self, 'file'):
             self.file.close()
 
-    def readcat(self):
-        self.file.seek(0)
-        namesector=self.file.read(sectorlen).decode(encoding='Latin1')
-        attribsector=self.file.read(sectorlen).decode(encoding='Latin1')
-        self.title=(namesector[0:7]+attribsector[0:3]).rstrip()
-        self.serial_no=ord(attribsector[4])
-        catlen=ord(attribsector[5])&0xfc
-        self.sectors=ord(attribsector[7])+((ord(attribsector[6])&0x07) << 8)
-        self.boot_options=(ord(attribsector[6])&0xf0) >> 4
-        self.file.seek(0,2)
-        self.ssd_size=self.file.tell()
-        self.cat=[]
-        for i in range(int(catlen/8)):
-            f=SsdFile(self, i)
-            self.cat.append(f)
+    def read_bytes(self, offset, length=None):
+        '''
+        Return length bytes (or all the rest) from offset into the image file.
+
+        When mapped this is a memoryview slice, otherwise a Latin-1 string.
+        '''
+        if self.image is not None:
+            if length is None:
+                return self.image[offset:]
+            return self.image[offset:offset+length]
+        with self.lock: # Files may be read from several threads at once
+            self.file.seek(offset)
+            if length is None:
+                return self.file.read().decode(encoding='Latin1')
+            return self.file.read(length).decode(encoding='Latin1')
+
+    def image_size(self):
+        '''
+        Return the size of the image file in bytes
+        '''
+        if self.image is not None:
+            return len(self.image)
+        self.file.seek(0,2)
+        return self.file.tell()
+
+    def iter_info(self, verbose):
+        if verbose>2:
+            self.load() # The report reads every part of the image
+        return super(SsdDisc, self).iter_info(verbose)
+
+    @stats.timed('catalogue decode')
+    def readcat(self):
+        namesector=bytearray(to_bytes(self.read_bytes(0, sectorlen)))
+        attribsector=bytearray(to_bytes(self.read_bytes(sectorlen, sectorlen)))
+        self.title=to_str(namesector[0:8]+attribsector[0:4]).rstrip()
+        self.serial_no=attribsector[4]
+        catlen=attribsector[5]&0xfc
+        self.sectors=attribsector[7]+((attribsector[6]&0x07) << 8)
+        self.boot_options=(attribsector[6]&0xf0) >> 4
+        self.ssd_size=self.image_size()
+        self.cat=[]
+        for i in range(catlen//8):
+            offset=8+i*8
+            self.cat.append(SsdFile(self, i,
+              namesector[offset:offset+8]+attribsector[offset:offset+8]
+            ))
+        self.sector_map=SectorMap(self.sectors)
+        self.sector_map.allocate(0, 2) # The catalogue
+        for f in self.cat:
+            self.sector_map.allocate(f.start_sector, -(-f.len//sectorlen))
+
+    def read(self, start_sector, length):
+        return self.read_bytes(start_sector*sectorlen, length)
+
+    def list_unused_sectors(self):
+        return self.sector_map.unused()
+
+    def read_sector(self, sector):
+        return self.read_bytes(sector*sectorlen, sectorlen)
+
+    def read_additional(self):
+        return self.read_bytes(self.sectors*sectorlen)
+
+    def read_unused_catalogue(self):
+        unused_len=sectorlen-8-len(self.cat)*8
+        return [
+          self.read_bytes(len(self.cat)*8+8, unused_len),
+          self.read_bytes(len(self.cat)*8+sectorlen+8, unused_len)
+        ]
+
+def side_size(size, side):
+    '''
+    Return how many bytes of a double-sided image of the given size belong
+    to side (0 or 1), given tracks alternate between the sides
+    '''
+    (pairs, rest)=divmod(size, 2*tracklen)
+    return pairs*tracklen+min(tracklen, max(0, rest-side*tracklen))
+
+def interleave_sides(images):
+    '''
+    Return a double-sided image as a bytearray, taking alternate tracks from
+    the two single-sided images given
+    '''
+    size=0
+    for (side, image) in enumerate(images):
+        if len(image):
+            (track, offset)=divmod(len(image)-1, tracklen)
+            size=max(size, (2*track+side)*tracklen+offset+1)
+    dsd=bytearray(size)
+    for (side, image) in enumerate(images):
+        for start in range(0, len(image), tracklen):
+            chunk=image[start:start+tracklen]
+            offset=(2*(start//tracklen)+side)*tracklen
+            dsd[offset:offset+len(chunk)]=chunk
+    return dsd
+
+class DoubleSided(object):
+    '''
+    Operations on a double-sided disc, made up of the two discs in self.sides.
+    DFS calls the second side drive 2, which is what its folder is named
+    when the disc is unpacked.
+    '''
+    drives=['0', '2']
+
+    def info(self, verbose):
+        return ''.join(self.iter_info(verbose))
+
+    def write_info(self, handle, verbose):
+        for r in self.iter_info(verbose):
+            handle.write(r)
+
+    def iter_info(self, verbose):
+        for (drive, side) in zip(self.drives, self.sides):
+            yield 'Drive {}:\n'.format(drive)
+            for r in side.iter_info(verbose):
+                yield r
+
+    def iter_records(self, files=False):
+        for (drive, side) in zip(self.drives, self.sides):
+            for record in side.iter_records(files):
+                record['drive']=int(drive)
+                yield record
+
+class DsdSide(SsdDisc):
+    '''
+    One side of a double-sided image, read as a single-sided disc.  Reads
+    are translated to the side's tracks in the image, and those that fit in
+    a track are served straight from the image without copying.  Reads
+    spanning tracks (most files) are joined into a copy of the data read.
+    '''
+    def __init__(self, dsddisc, side):
+        DfsDisc.__init__(self)
+        self.dsddisc=dsddisc
+        self.side=side
+        self.image=None
+        self.mapping=None
+        self.readcat()
+
+    def close(self):
+        self.dsddisc=None
+
+    def load(self):
+        self.dsddisc.load()
+
+    def image_size(self):
+        return side_size(self.dsddisc.image_size(), self.side)
+
+    def read_bytes(self, offset, length=None):
+        if length is None:
+            length=max(0, self.ssd_size-offset)
+        pieces=[]
+        while length>0:
+            (track, start)=divmod(offset, tracklen)
+            count=min(length, tracklen-start)
+            piece=self.dsddisc.read_bytes(
+              (2*track+self.side)*tracklen+start, count
+            )
+            if len(piece)==0:
+                break
+            pieces.append(piece)
+            offset+=count
+            length-=count
+        if len(pieces)==0:
+            return self.dsddisc.read_bytes(0, 0)
+        elif len(pieces)==1:
+            return pieces[0]
+        elif isinstance(pieces[0], memoryview):
+            # Spans tracks, so the pieces aren't next to each other
+            return memoryview(b''.join([p.tobytes() for p in pieces]))
+        return pieces[0][:0].join(pieces)
+
+class DsdDisc(DoubleSided, SsdDisc):
+    '''
+    A double-sided image, with tracks alternating between the sides every
+    tracksectors sectors.  Each side is a DsdSide in self.sides.
+    '''
+    def readcat(self):
+        self.ssd_size=self.image_size()
+        self.sides=[DsdSide(self, 0), DsdSide(self, 1)]
+
+    def close(self):
+        for side in getattr(self, 'sides', []):
+            side.close()
+        super(DsdDisc, self).close()
+
+    def write_as_files(self, dir, store=None, threads=None):
+        if os.path.exists(dir) and (
+          not os.path.isdir(dir) or os.listdir(dir)
+        ):
+            raise RuntimeError(
+              '{} exists and is not an empty directory'.format(dir)
+            )
+        created=not os.path.exists(dir)
+        try:
+            for (drive, side) in zip(self.drives, self.sides):
+                side.write_as_files(os.path.join(dir, drive), store, threads)
+        except BaseException:
+            if os.path.isdir(dir):
+                clear_dir(dir, created)
+            raise
+
+class DirDsdDisc(DoubleSided):
+    '''
+    A double-sided disc unpacked into a directory, with a folder for each
+    side as written by DsdDisc.write_as_files()
+    '''
+    def __init__(self, directory, verbose):
+        self.dir=directory
+        self.sides=[
+          DirDisc(os.path.join(directory, drive), verbose)
+            for drive in self.drives
+        ]
+
+    def fit_files(self):
+        for side in self.sides:
+            side.fit_files()
+
+    def build_dsd(self):
+        return interleave_sides([side.build_ssd() for side in self.sides])
+
+    def write_as_dsd(self, filename):
+        image=self.build_dsd()
+        with stats.open(filename,'wb') as handle:
+            handle.write(image)
+
+def is_dsd_dir(directory):
+    '''
+    Report whether directory holds an unpacked double-sided disc
+    '''
+    return all(
+      [os.path.isdir(os.path.join(directory, d)) for d in DoubleSided.drives]
+    ) and not os.path.isfile(os.path.join(directory, '..THIS_DISK.inf'))
+
+def is_dsd_name(path):
+    '''
+    Report whether path is named as a double-sided image (.dsd or .dsd.gz)
+    '''
+    name=path.lower()
+    if name.endswith('.gz'):
+        name=name[:-3]
+    return name.endswith('.dsd')
+
+def open_image(path, mapped=False):
+    '''
+    Open the disc image at path, as a DsdDisc if it's named .dsd (or
+    .dsd.gz), otherwise as an SsdDisc
+    '''
+    if is_dsd_name(path):
+        return DsdDisc(path, mapped=mapped)
+    return SsdDisc(path, mapped=mapped)
+
+def find_images(directory):
+    '''
+    Yield the paths of all the .ssd and .dsd images under directory, walking
+    it in sorted order.  Gzipped images are included, as are the images in
+    any zip archives.
+    '''
+    for (root, dirs, files) in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if is_image_name(filename):
+                yield os.path.join(root, filename)
+            elif filename.lower().endswith('.zip'):
+                for image in archives.images(os.path.join(root, filename)):
+                    yield image
+
+def catalogue_image(job):
+    '''
+    Catalogue a single (path, verbose, mapped, as_json) job for
+    catalogue_images().
+
+    Returns a (path, info, error) tuple, where info is JSON Lines as from
+    write_json() if as_json is True; errors are reported as a message
+    rather than raised, so one bad image doesn't stop a whole run.
+    '''
+    (path, verbose, mapped, as_json)=job
+    try:
+        d=open_image(path, mapped=mapped)
+        try:
+            if as_json:
+                out=io.StringIO() if str is not bytes else io.BytesIO()
+                write_json(out, d.iter_records(verbose>0), path=path)
+                return (path, out.getvalue(), None)
+            return (path, d.info(verbose), None)
+        finally:
+            d.close()
+    except Exception as e:
+        return (path, None, '{}: {}'.format(type(e).__name__, e))
+
+def pool_map(function, tasks, jobs=None):
+    '''
+    Run function over tasks across a pool of worker processes (one per core
+    unless jobs says otherwise), yielding each result as soon as it's done,
+    in whatever order they finish.
+    '''
+    import multiprocessing
+    pool=multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(function, tasks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def catalogue_images(
+  paths, verbose=0, mapped=False, jobs=None, as_json=False
+):
+    '''
+    Catalogue many images across a pool of worker processes, yielding a
+    (path, info, error) tuple for each image as it's done.
+    '''
+    return pool_map(
+      catalogue_image,
+      ((path, verbose, mapped, as_json) for path in paths), jobs
+    )
+
+def batch_targets(inputs, root):
+    '''
+    Yield an (image, directory) pair for each image to be unpacked under
+    root.  Images given directly unpack into a directory named after them;
+    directories are searched for images, which keep their relative paths.
+
+    The directory is None for an image that can't be unpacked safely under
+    root, such as a zip archive member named ../../Elite.ssd.
+    '''
+    def target(image, start):
+        (archive, member)=split_member(image)
+        relative=os.path.relpath(archive, start)
+        if member!=None:
+            relative+=':'+member
+        try:
+            directory=os.path.join(root, image_stem(relative))
+        except ValueError:
+            return (image, None)
+        top=os.path.abspath(root)
+        if not os.path.abspath(directory).startswith(os.path.join(top, '')):
+            return (image, None)
+        return (image, directory)
+    for i in inputs:
+        if os.path.isdir(i):
+            for image in find_images(i):
+                yield target(image, i)
+        elif i.lower().endswith('.zip'):
+            parent=os.path.dirname(i) or '.'
+            for image in archives.images(i):
+                yield target(image, parent)
+        else:
+            yield (i, os.path.join(
+              root, os.path.basename(image_stem(i))
+            ))
+
+def unpack_image(job):
+    '''
+    Unpack a single (path, directory, mapped, store, threads) job for
+    unpack_images(), where store is the root of a BlobStore, or None, and
+    threads the number of threads to write each disc's files with.
 
-    def read(self, start_sector, length):
-        self.file.seek(start_sector*sectorlen)
-        return self.file.read(length).decode(encoding='Latin1')
+    Returns a (path, directory, size, error) tuple, where size is the size
+    of the image file; errors are reported as a message rather than raised.
+    '''
+    (path, directory, mapped, store, threads)=job
+    try:
+        d=open_image(path, mapped=mapped)
+        try:
+            d.write_as_files(
+              directory, BlobStore(store) if store!=None else None, threads
+            )
+            return (path, directory, d.ssd_size, None)
+        finally:
+            d.close()
+    except Exception as e:
+        return (path, directory, 0, '{}: {}'.format(type(e).__name__, e))
 
-    def list_unused_sectors(self):
-        ordered=sorted(self.cat,key=lambda fil:fil.start_sector)
-        end=1 # End of the catalogue
-        s=[]
-        for i in range(len(ordered)):
-            s=s+list(range(end+1,ordered[i].start_sector))
-            end=ordered[i].start_sector+int(ordered[i].len / sectorlen)
-            if ordered[i].len % sectorlen == 0:
-                end-=1
-        s=s+list(range(end+1,self.sectors))
-        return s
+def unpack_images(targets, mapped=False, jobs=None, store=None, threads=None):
+    '''
+    Unpack many (image, directory) pairs across a pool of worker processes,
+    yielding a (path, directory, size, error) tuple for each as it's done.
+    If store is given, the files are kept in a BlobStore rooted there; if
+    threads is given, each worker writes that many files at once.
+
+    Any image bound for the same directory as an earlier one, or for one
+    inside or containing it (as with Games.zip:Elite.ssd and Games.ssd),
+    fails straight away, rather than racing the other into it.  So does
+    any without a directory (None), which batch_targets() gives for images
+    it can't unpack safely.
+    '''
+    tasks=[]
+    used=set()
+    containing=set() # The directories above those in used
+    for (image, directory) in targets:
+        if directory==None:
+            yield (image, directory, 0,
+              'Its name would put it outside the output directory'
+            )
+            continue
+        path=os.path.normpath(os.path.abspath(directory))
+        above=[]
+        (child, parent)=(path, os.path.dirname(path))
+        while parent!=child:
+            above.append(parent)
+            (child, parent)=(parent, os.path.dirname(parent))
+        if path in used or path in containing or used.intersection(above):
+            yield (image, directory, 0,
+              'Another image is being unpacked to or within {}'.format(
+                directory
+              )
+            )
+        else:
+            used.add(path)
+            containing.update(above)
+            tasks.append((image, directory, mapped, store, threads))
+    for result in pool_map(unpack_image, tasks, jobs):
+        yield result
 
-    def read_sector(self, sector):
-        self.file.seek(sector*sectorlen)
-        return self.file.read(sectorlen).decode(encoding='Latin1')
+class CatalogueIndex(object):
+    '''
+    A SQLite database of the catalogues of a library of disc images, so
+    files can be looked up without opening every image.  Images are keyed
+    by absolute path, size and modification time, so rescanning only reads
+    the ones that have changed, whatever directory it's run from.  Each
+    side of a double-sided image is a separate disc in the index.
+    '''
+    def __init__(self, filename):
+        import sqlite3
+        self.db=sqlite3.connect(filename)
+        self.db.executescript('''
+          CREATE TABLE IF NOT EXISTS discs (
+            id INTEGER PRIMARY KEY, path TEXT, side INTEGER,
+            size INTEGER, mtime REAL, title TEXT, serial_no INTEGER,
+            sectors INTEGER, boot_options INTEGER, UNIQUE (path, side)
+          );
+          CREATE TABLE IF NOT EXISTS files (
+            disc INTEGER, catnum INTEGER, dir TEXT, name TEXT,
+            locked INTEGER, load_address INTEGER, exec_address INTEGER,
+            length INTEGER, start_sector INTEGER
+          );
+          CREATE INDEX IF NOT EXISTS files_name ON files (name COLLATE NOCASE);
+          CREATE INDEX IF NOT EXISTS files_disc ON files (disc);
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def key(self, path):
+        '''
+        Return the path the image at path is indexed by: its absolute path,
+        or for a zip archive member the archive's absolute path and the
+        member's name
+        '''
+        (archive, member)=split_member(path)
+        archive=os.path.abspath(archive)
+        return archive if member==None else archive+':'+member
 
-    def read_additional(self):
-        self.file.seek(self.sectors*sectorlen)
-        return self.file.read().decode(encoding='Latin1')
+    def forget(self, path):
+        '''
+        Remove the image at path from the index
+        '''
+        path=self.key(path)
+        self.db.execute(
+          'DELETE FROM files WHERE disc IN (SELECT id FROM discs WHERE path=?)',
+          (path,)
+        )
+        self.db.execute('DELETE FROM discs WHERE path=?', (path,))
 
-    def read_unused_catalogue(self):
-        self.file.seek(len(self.cat)*8+8)
-        u=[self.file.read(sectorlen-8-len(self.cat)*8).decode(
-          encoding='Latin1'
-        )]
-        self.file.seek(len(self.cat)*8+sectorlen+8)
-        u.append(self.file.read(sectorlen-8-len(self.cat)*8).decode(
-          encoding='Latin1'
-        ))
-        return u
+    def scan(self, paths):
+        '''
+        Bring the index up to date with the images at paths, yielding a
+        (path, changed, error) tuple for each.  Images whose size and
+        modification time match the index aren't opened.
+        '''
+        for path in paths:
+            try:
+                stat=os.stat(split_member(path)[0])
+                row=self.db.execute(
+                  'SELECT size, mtime FROM discs WHERE path=? LIMIT 1',
+                  (self.key(path),)
+                ).fetchone()
+                if row!=None and tuple(row)==(stat.st_size, stat.st_mtime):
+                    yield (path, False, None)
+                    continue
+                d=open_image(path)
+                try:
+                    self.forget(path)
+                    for (side, disc) in enumerate(getattr(d, 'sides', [d])):
+                        self.add(path, side, stat, disc)
+                finally:
+                    d.close()
+                self.db.commit()
+                yield (path, True, None)
+            except Exception as e:
+                self.db.rollback()
+                yield (path, False, '{}: {}'.format(type(e).__name__, e))
+
+    def add(self, path, side, stat, disc):
+        cursor=self.db.execute(
+          'INSERT INTO discs (path, side, size, mtime, title, serial_no,'
+          ' sectors, boot_options) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+          (self.key(path), side, stat.st_size, stat.st_mtime, disc.title,
+            disc.serial_no, disc.sectors, disc.boot_options)
+        )
+        self.db.executemany(
+          'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          [(cursor.lastrowid, f.catnum, f.dir, f.name, int(f.loc),
+            f.load_address, f.exec_address, f.len, f.start_sector)
+            for f in disc.cat]
+        )
 
-    def output_bin(self, heading, data):
-        r=heading+' '*((0-len(heading.split('\n')[-1])) % 5)
-        if len(data)==0:
-            r+='None'
-        while len(data)>1:
-            r+='{:02x}{:02x} '.format(ord(data[0]),ord(data[1]))
-            data=data[2:]
-        if len(data)==1:
-            r+='{:02x}'.format(ord(data[0]))
-        return r
+    def prune(self):
+        '''
+        Remove the images that no longer exist from the index, returning
+        how many there were
+        '''
+        gone=[path for (path,) in self.db.execute(
+          'SELECT DISTINCT path FROM discs'
+        ) if not os.path.exists(split_member(path)[0])]
+        for path in gone:
+            self.forget(path)
+        self.db.commit()
+        return len(gone)
+
+    def query(self, name='*', load_address=None, exec_address=None):
+        '''
+        Find files by name, optionally with a directory (e.g. $.ELITE), where
+        * and # are wildcards for any characters and any one character, as
+        with DFS.  Addresses that fit in 16 bits match the bottom 16 bits of
+        the file's address, so 1900 finds files loading at FF1900 too.
 
-    def info(self, verbose):
-        if verbose:
-            r='Title: {}\nSerial no:{}\n'
-        else:
-            r='{} ({})\n'
-        r=r.format(self.title,self.serial_no)
-        if verbose:
-            k=self.sectors*sectorlen/1024
-            r+='Total sectors:0x{:03x} ({}K)\n'.format(
-              self.sectors, int(k) if int(k) == k else k # Tidy py3 fractions
-            )
-        if verbose>1:
-            if self.ssd_size != self.sectors * sectorlen:
-                r+='INFO: Actual size 0x{:03x} sectors{}\n'.format(
-                  self.ssd_size//sectorlen,
-                  ' with {} extra byte(s)'.format(self.ssd_size % sectorlen)
-                    if self.ssd_size % sectorlen != 0 else ''
-                )
-        opt4=['off','LOAD','RUN','EXEC']+['invalid']*12
-        r+='Option {} ({})\n'.format(
-          self.boot_options, opt4[self.boot_options]
-        )
-        cat=self.cat
-        if not verbose:
-            cat=sorted(cat,key=lambda fil:fil.dir+'.'+fil.name)
-        i=0
-        for f in cat:
-            if verbose:
-                r+='File {}: {}{}\n'.format(
-                  i+1, f.info(),
-                  ' cropped!'
-                    if f.start_sector*sectorlen+f.len > self.ssd_size
-                    else
-                  ''
-                )
-                if verbose>2:
-                    r+=self.output_bin('Additional data: ', f.read_after())+'\n'
-            else:
-                r+=f.info()+'\n'
-            i+=1
-        if verbose>2:
-            u=self.read_unused_catalogue()
-            r+=self.output_bin('Unused in sector 0x000: ', u[0])+'\n'
-            r+=self.output_bin('Unused in sector 0x001: ' ,u[1])+'\n'
-        if verbose>1:
-            u=self.list_unused_sectors()
-            if len(u)==0:
-                r+='All sectors are in use'
-            else:
-                r+='Unused sectors:'
-                for s in u:
-                    if (s*sectorlen) >= self.ssd_size:
-                        break
-                    if verbose>2:
-                        r+=self.output_bin(
-                          '\n- Sector 0x{:03x}: '.format(s),
-                          self.read_sector(s)
-                        )
-                    else:
-                        r+='0x{:03x} '.format(s)
-                if self.sectors > self.ssd_size//sectorlen:
-                    # More sectors declared than are in the file
-                    r+='\nSector'
-                    if self.ssd_size//sectorlen == self.sectors-1:
-                        r+=' 0x{:03x} cropped'.format(self.sectors-1)
-                    else:
-                        r+='s 0x{:03x}-0x{:03x} cropped'.format(
-                          self.ssd_size//sectorlen, self.sectors-1
-                        )
-                r+='\n'
-        if verbose>2:
-            a=self.read_additional()
-            if a:
-                r+=self.output_bin('Data after disc image: ',a)+'\n'
-            else:
-                r+='No data after disc image\n'
-        return r
-
-class TestSsdDisc(unittest.TestCase):
-    def setUp(self):
-        self.d=SsdDisc('./test_data/Test1.ssd')
-
-    def test_disc(self):
-        self.assertEqual(self.d.title, 'TEST')
-        self.assertEqual(self.d.serial_no, 0x11)
-        self.assertEqual(self.d.sectors, 56)
-        self.assertEqual(self.d.boot_options, 3)
-        self.assertEqual(self.d.ssd_size % sectorlen, 1)
-
-    def test_file(self):
-        f=[f for f in self.d.cat if f.name=='!BOOT'][0]
-        self.assertEqual(len(f.read()), 14)
-        self.assertEqual(len(f.read_after()), 242)
-
-    def test_list_unused_sectors(self):
-        self.assertEqual(len(self.d.list_unused_sectors()), 1)
-        self.assertEqual(self.d.list_unused_sectors()[0], 0x28)
-
-    def test_read_additional(self):
-        self.assertEqual(len(self.d.read_additional()), 1)
-        self.assertEqual(ord(self.d.read_additional()[0]), 0x00)
-
-    def test_read_unused_catalogue(self):
-        u=self.d.read_unused_catalogue()
-        self.assertEqual(len(u[0]), 208)
-        self.assertEqual(len(u[1]), 208)
-        self.assertEqual(ord(u[0][0]), 0x10)
-        self.assertEqual(ord(u[0][-1]), 0x01)
-        self.assertEqual(ord(u[1][0]), 0xf0)
-        self.assertEqual(ord(u[1][-1]), 0x0f)
+        Returns a list of (path, side, DfsFile) tuples.
+        '''
+        where=[]
+        args=[]
+        if name[1:2]=='.':
+            where.append('dir=?')
+            args.append(name[0])
+            name=name[2:]
+        pattern=''.join([
+          '%' if c=='*' else '_' if c=='#' else
+          '\\'+c if c in '%_\\' else c for c in name
+        ])
+        where.append("name LIKE ? ESCAPE '\\'")
+        args.append(pattern)
+        for (column, address) in (
+          ('load_address', load_address), ('exec_address', exec_address)
+        ):
+            if address!=None:
+                if address<=0xffff:
+                    column='({} & 65535)'.format(column)
+                where.append(column+'=?')
+                args.append(address)
+        results=[]
+        for row in self.db.execute(
+          'SELECT path, side, dir, name, locked, load_address, exec_address,'
+          ' length, start_sector, catnum FROM files JOIN discs'
+          ' ON files.disc=discs.id WHERE '+' AND '.join(where)+
+          ' ORDER BY path, side, catnum', args
+        ):
+            f=DfsFile()
+            (f.dir, f.name, f.loc, f.load_address, f.exec_address, f.len,
+              f.start_sector, f.catnum)=row[2:]
+            f.loc=bool(f.loc)
+            results.append((row[0], row[1], f))
+        return results
 
 class ParseUtils(object):
     def __init__(self,directory,verbose):
@@ -425,14 +1648,22 @@ class ParseUtils(object):
             return 0
 
     def text2bin(self, value, message):
-        data=''
-        while len(value)>=2:
-            data+=chr(self.hex2int(value[0:2]))
-            value=value[2:]
-        if len(value)==1:
+        '''
+        Return the bytes written in hex in value.  A pair of digits that
+        isn't hex is read as a zero byte, as is an odd digit at the end.
+        '''
+        end=len(value)-len(value)%2
+        try:
+            data=binascii.unhexlify(value[:end])
+        except (TypeError, ValueError):
+            # Decode pair by pair, to warn about (and zero) each bad one
+            data=bytes(bytearray([
+              self.hex2int(value[i:i+2]) for i in range(0, end, 2)
+            ]))
+        if end<len(value):
             if self.verbose:
                 print(message, 'has odd length; wiping last byte')
-            data+='\0'
+            data+=b'\0'
         return data
 
     def line(self,line,keys,filename):
@@ -454,7 +1685,7 @@ class ParseUtils(object):
                     ))
 
     def file(self, keys, filename):
-        with open(os.path.join(self.dir,filename),'r') as handle:
+        with stats.open(os.path.join(self.dir,filename),'r') as handle:
             for l in handle.readlines():
                 self.line(l.rstrip('\n'), keys, filename)
 
@@ -468,28 +1699,106 @@ class DirFileConflict(Exception):
     '''
     pass
 
+class FileCache(object):
+    '''
+    A least recently used cache of the contents of host files, keyed by
+    path and modification time, which holds no more than budget bytes.
+    '''
+    def __init__(self, budget=2**24):
+        self.budget=budget
+        self.size=0
+        self.entries=collections.OrderedDict()
+
+    def read(self, path):
+        '''
+        Return the contents of the file at path, from the cache if it's
+        there and the file hasn't been modified since
+        '''
+        mtime=os.path.getmtime(path)
+        entry=self.entries.pop(path, None)
+        if entry!=None:
+            if entry[0]==mtime:
+                self.entries[path]=entry # Now the most recently used
+                return entry[1]
+            self.size-=len(entry[1])
+        with stats.open(path,'rb') as handle:
+            data=handle.read()
+        if len(data)<=self.budget:
+            self.entries[path]=(mtime, data)
+            self.size+=len(data)
+            while self.size>self.budget:
+                self.size-=len(self.entries.popitem(last=False)[1][1])
+        return data
+
+    def invalidate(self, path):
+        '''
+        Forget any cached contents of the file at path
+        '''
+        entry=self.entries.pop(path, None)
+        if entry!=None:
+            self.size-=len(entry[1])
+
+def list_files(directory):
+    '''
+    Return a dict of the names of the files in directory to their sizes,
+    taken from a single scan of it rather than opening each file.  Anything
+    that isn't a file (or a link to one), such as a folder, is left out.
+    '''
+    files={}
+    try:
+        scandir=os.scandir
+    except AttributeError:
+        # Python 2 has no scandir, so stat each name listed instead
+        for name in os.listdir(directory):
+            path=os.path.join(directory, name)
+            if os.path.isfile(path):
+                files[name]=os.path.getsize(path)
+        return files
+    for entry in scandir(directory):
+        if entry.is_file():
+            files[entry.name]=entry.stat().st_size
+    return files
+
 class DirFile(DfsFile):
-    def __init__(self, directory, filename, get_sector, set_sector, verbose):
+    def __init__(
+      self, directory, filename, get_sector, set_sector, verbose, cache=None,
+      size=None, files=None
+    ):
         super(DirFile, self).__init__()
         self.verbose=verbose
         self.after=[]
         self.get_sector=get_sector
         self.set_sector=set_sector
+        self.cache=cache
         self.registered=True
-        self.parse_file(directory,filename)
+        self.parse_file(directory, filename, size, files)
 
-    def parse_file(self, directory, filename):
+    def parse_file(self, directory, filename, size=None, files=None):
+        '''
+        Read the file's details from its length and its .inf and .inf2 files.
+        If the directory's already been listed, size is the file's length and
+        files the names in the directory (e.g. from list_files()), so neither
+        needs looking up.
+        '''
         self.path=os.path.join(directory, filename)
         parse=ParseUtils(directory, self.verbose)
+        def exists(name):
+            if files!=None:
+                return name in files
+            return os.path.isfile(os.path.join(directory, name))
         # Set default values for new files
-        with open(os.path.join(directory,filename),'r') as handle:
-            handle.seek(0,2)
-            self.len=handle.tell()
-        self.after=[0]*(sectorlen-(self.len-1)%sectorlen-1)
+        self.len=size if size!=None else os.path.getsize(self.path)
+        self.after=b'\0'*(-self.len%sectorlen)
+        if filename[1:2]=='.':
+            self.dir=filename[0]
+            self.filename=filename[2:]
+        else:
+            self.dir='$'
+            self.filename=filename
         # Parse inf files
         inf_filename=os.path.join(directory,'.'+filename+'.inf')
-        if os.path.isfile(inf_filename):
-            with open(inf_filename,'r') as f:
+        if exists('.'+filename+'.inf'):
+            with stats.open(inf_filename,'r') as f:
                 for line in f.readlines():
                     line=line.rstrip('\n').lstrip()
                     i=0
@@ -498,11 +1807,11 @@ class DirFile(DfsFile):
                         if i==1:
                             path=arg
                             path=path.rstrip(', ')
-                            if path[1]=='.':
+                            if path[1:2]=='.':
                                 self.dir=path[0]
                                 self.filename=path[2:]
                             else:
-                                self.dir=''
+                                self.dir='$'
                                 self.filename=path
                         else:
                             try:
@@ -533,24 +1842,14 @@ class DirFile(DfsFile):
                                       )
                                     )
 
-        if os.path.isfile(inf_filename+'2'):
+        if exists('.'+filename+'.inf2'):
             def Start(value): self.start_sector=parse.hex2int(value)
             def Len(value): self.len=parse.str2int(value)
             def Index(value): self.catnum=parse.str2int(value)
             def After(value):
-                self.after=b''
-                while len(value)>=2:
-                    self.after+=self.__str2bytes(
-                      chr(parse.hex2int(value[:2]))
-                    )
-                    value=value[2:]
-                if len(value)==1:
-                    if self.verbose:
-                        print('Warning: After for {} has odd length;'.format(
-                          self.filename
-                        ), 'wiping last byte'
-                        )
-                    self.after+=b'\0'
+                self.after=parse.text2bin(
+                  value, 'Warning: After for {}'.format(self.filename)
+                )
             parse.file(
               {
               'Start sector':Start, 'Length':Len,
@@ -558,51 +1857,40 @@ class DirFile(DfsFile):
               }, '.'+filename+'.inf2'
             )
 
+    @property
+    def name(self):
+        return self.filename
+
+    @name.setter
+    def name(self, value):
+        self.filename=value
+
     def fit_file(self):
         if self.registered:
             self.unregister()
+        if self.cache!=None:
+            self.cache.invalidate(self.path)
+        # Its length now (which may have changed since the directory was
+        # scanned), rather than as it was unpacked; this doesn't open it
+        self.len=os.path.getsize(self.path)
 
-        with open(self.path,'rb') as handle:
-            handle.seek(0,2)
-            self.len=handle.tell()
-
-        self.register()
+        try:
+            self.register()
+        except DirFileConflict:
+            pass # Left unregistered, for is_conflicting() to report
 
     def read(self):
-        with open(self.path,'rb') as handle:
+        if self.cache!=None:
+            return self.cache.read(self.path)
+        with stats.open(self.path,'rb') as handle:
             return handle.read()
 
     def read_after(self):
         return self.after
 
-    def get_cat_data(self):
-        '''
-        Get the 8 bytes of data that go into sector 0 for every file on a disc
-        '''
-        block='{:<7s}'.format(self.filename)
-        dirflag=ord(self.dir[0])
-        if self.loc:
-            dirflag=dirflag | 0x80
-        block+=chr(dirflag)
-        return self.__str2bytes(block)
-
-    def get_attrib_data(self):
-        '''
-        Get the 8 bytes of data that go into sector 1 for every file on a disc
-        '''
-        return self.__str2bytes(chr((self.load_address & 0x00ff00) >> 8
-        )+chr(self.load_address & 0x0000ff
-        )+chr((self.exec_address & 0x00ff00) >> 8
-        )+chr(self.exec_address & 0x0000ff
-        )+chr((self.len & 0x00ff00) >> 8
-        )+chr(self.len & 0x0000ff
-        )+chr(
-            ((self.exec_address & 0x030000) >> 10) + # 0b11000000
-            ((self.len & 0x030000) >> 12) +  # 0b001100000
-            ((self.load_address & 0x030000) >> 14) + # 0b00001100
-            ((self.start_sector & 0x0300) >> 8) # 0b00000011
-        )+chr(self.start_sector & 0x0000ff
-        ))
+    def read_into(self, buffer):
+        with stats.open(self.path,'rb') as handle:
+            handle.readinto(buffer)
 
     def is_conflicting(self):
         '''
@@ -617,11 +1905,13 @@ class DirFile(DfsFile):
 
     def unregister(self):
         if self.registered:
-            lastsector=self.start_sector-self.len//-sectorlen-1
-            for s in range(self.start_sector, lastsector):
-                self.set_sector(s,b'\0'*sectorlen)
-            last_len=sectorlen-len(self.after)
-            self.set_sector(lastsector, b'\0'*last_len+self.after)
+            if self.len!=0: # Empty files don't occupy any sectors
+                lastsector=self.start_sector-self.len//-sectorlen-1
+                for s in range(self.start_sector, lastsector):
+                    self.set_sector(s,b'\0'*sectorlen)
+                after=bytes(bytearray(to_bytes(self.after)))
+                last_len=sectorlen-len(after)
+                self.set_sector(lastsector, b'\0'*last_len+after)
             self.registered=False
         else:
             raise DirFileFailure(
@@ -629,7 +1919,10 @@ class DirFile(DfsFile):
             )
 
     def register(self):
-        if not self.registered:
+        if not self.registered and self.len==0:
+            self.after=b''
+            self.registered=True
+        elif not self.registered:
             last_sector=self.start_sector-self.len//-sectorlen-1
             # Check for conflicts
             for s in range(self.start_sector, last_sector+1):
@@ -654,240 +1947,31 @@ class DirFile(DfsFile):
     def move(self, new_start_sector):
         if self.registered:
             self.unregister()
+        if self.cache!=None:
+            self.cache.invalidate(self.path)
         try:
             self.start_sector=new_start_sector
             self.register()
         except DirFileConflict as e:
             raise DirFileFailure('Trying to move to occupied space!',e)
 
-    def __str2bytes(self,str):
-        try:
-            return str.encode('Latin1')
-        except UnicodeDecodeError:
-            # Python2 strings can contain top bit set characters but can't
-            # be encoded since it tries to decode it as 7-bit ascii first
-            # Luckily, in python2 bytes objects are just 8-bit strings, so:
-            return str
-
-class TestDirFile(unittest.TestCase):
-    def setUp(self):
-        def get_sector(sector): return [0]*sectorlen
-        def set_sector(sector,data): pass
-        self.f=DirFile(
-          os.path.join('test_data','DirTest1'),
-          '$.FILE1',
-          get_sector,set_sector,
-          1
-        )
-        self.get_s=get_sector
-        self.set_s=set_sector
-        def error_sector(*args): self.assertTrue(False,'error_sector({}) called'.format(','.join([str(a) for a in args])))
-        self.error_sector=error_sector
-
-    def make_dirfile(self, filename, get_s, set_s, verbose):
-        return DirFile(
-          os.path.join('test_data','DirFileTest'),
-          filename,
-          get_s,
-          set_s,
-          verbose
-        )
-
-    def test_filename(self):
-        self.assertEqual(self.f.filename, 'FILE1')
-
-    def test_dir(self):
-        self.assertEqual(self.f.dir, '$')
-
-    def test_load_address(self):
-        self.assertEqual(self.f.load_address, 0xFF1900)
-        newfile=self.make_dirfile('NEWFILE', self.get_s, self.set_s, 0)
-        self.assertEqual(newfile.load_address,0x1900)
-
-    def test_exec_address(self):
-        self.assertEqual(self.f.exec_address, 0xFF8023)
-        newfile=self.make_dirfile('NEWFILE', self.get_s, self.set_s, 0)
-        self.assertEqual(newfile.exec_address,0x1900)
-
-    def test_start_sector(self):
-        self.assertEqual(self.f.start_sector, 0x002)
-        newfile=self.make_dirfile('NEWFILE', self.get_s, self.set_s, 0)
-        self.assertEqual(newfile.start_sector,2)
-
-    def test_len(self):
-        self.assertEqual(self.f.len, 270)
-
-    def test_catnum(self):
-        self.assertEqual(self.f.catnum, 0)
-        newfile=self.make_dirfile('NEWFILE', self.get_s, self.set_s, 0)
-        self.assertEqual(newfile.catnum,None)
-        growaligned=self.make_dirfile('ALIGNED', self.get_s, self.set_s, 0)
-        self.assertEqual(growaligned.catnum, 2)
-
-    def test_read(self):
-        self.assertEqual(len(self.f.read()), self.f.len)
-        newfile=self.make_dirfile('NEWFILE', self.get_s, self.set_s, 0)
-        self.assertEqual(len(newfile.read()), newfile.len)
-
-    def test_read_after(self):
-        self.assertEqual(len(self.f.read_after()),256-(self.f.len%256))
-        # Test corrupted bytes after last sector entry
-        oddafter=self.make_dirfile('ODDAFTER', self.error_sector, self.error_sector, 0)
-        oddafter_read=oddafter.read_after()
-        self.assertEqual(
-          (len(oddafter_read)+oddafter.len+1)%sectorlen, 0
-        )
-        # Getting ranges because indexes of bytes under python3 gives an int
-        self.assertEqual(oddafter_read[:1],b'\xff')
-        self.assertEqual(oddafter_read[-2:-1],b'\xff')
-        self.assertEqual(oddafter_read[-1:],b'\0')
-
-    def test_get_cat_data(self):
-        self.assertEqual(len(self.f.get_cat_data()),8)
-        self.assertEqual(self.f.get_cat_data()[:7],b'FILE1  ')
-
-    def test_get_attrib_data(self):
-        self.assertEqual(len(self.f.get_attrib_data()),8)
-        self.assertEqual(self.f.get_attrib_data()[:2],b'\x19\x00')
-
-    def test_unregister(self):
-        def set_s(s,v):
-            if v==None:
-                l_set_none.append(s)
-            elif v==b'\0'*sectorlen:
-                l_set_empty.append(s)
-            else:
-                self.assertEqual(len(v), sectorlen)
-
-        l_set_none=[]
-        l_set_empty=[]
-        aligned=self.make_dirfile('ALIGNED', self.error_sector, set_s, 0)
-        self.assertTrue(aligned.registered)
-        aligned.unregister()
-        self.assertEqual(l_set_none,[])
-        self.assertEqual(l_set_empty,[3,4,5])
-        self.assertFalse(aligned.registered)
-
-        l_set_none=[]
-        l_set_empty=[]
-        unaligned=self.make_dirfile('UNALIGNED', self.error_sector, set_s, 0)
-        self.assertTrue(unaligned.registered)
-        unaligned.unregister()
-        self.assertEqual(l_set_none,[])
-        self.assertEqual(l_set_empty,[3,4])
-        self.assertFalse(unaligned.registered)
-
-        self.assertRaises(DirFileFailure, unaligned.unregister)
-
-    def test_register(self):
-        def get_s(s):
-            l_got_s.append(s)
-            return [0]*sectorlen
-
-        def set_s(s,v):
-            if v==None:
-                l_set_none.append(s)
-            else:
-                self.assertTrue(False, 'Told to set sector {} with {}'.format(s,v))
-        l_got_s=[]
-        l_set_none=[]
-        aligned=self.make_dirfile('ALIGNED', get_s, set_s, 0)
-        aligned.registered=False
-        aligned.register()
-        self.assertEqual(l_set_none,[3,4,5])
-        self.assertEqual(l_got_s, [3,4,5,5])
-        self.assertEqual(len(aligned.read_after()),0)
-        self.assertTrue(aligned.registered)
-
-        def get_conflicting(s):
-            if s==5:
-                return None
-            else:
-                l_got_s.append(s)
-                return [0]*sectorlen
-
-        l_got_s=[]
-        l_set_none=[]
-        conflicting=self.make_dirfile('ALIGNED', get_conflicting, set_s, 0)
-        conflicting.registered=False
-        self.assertRaises(DirFileConflict, conflicting.register)
-        self.assertEqual(l_set_none,[])
-        self.assertEqual(l_got_s, [3,4])
-        self.assertFalse(conflicting.registered)
-
-        l_got_s=[]
-        l_set_none=[]
-        unaligned=self.make_dirfile('UNALIGNED', get_s, set_s, 0)
-        unaligned.registered=False
-        unaligned.register()
-        self.assertEqual(l_set_none,[3,4,5])
-        self.assertEqual(l_got_s, [3,4,5,5])
-        self.assertEqual(len(unaligned.read_after()),sectorlen-8)
-        self.assertTrue(unaligned.registered)
-
-        self.assertRaises(DirFileFailure, unaligned.register)
-
-    def test_is_conflicting(self):
-        t=self.make_dirfile('ALIGNED', self.error_sector, self.error_sector, 0)
-        self.assertFalse(t.is_conflicting())
-        t.registered=False
-        self.assertTrue(t.is_conflicting())
-
-    def test_fit_file(self):
-        def get_s(s):
-            l_got_s.append(s)
-            return [0]*sectorlen
-
-        def set_s(s,v):
-            if v==None:
-                l_set_none.append(s)
-            elif v==b'\0'*sectorlen:
-                l_set_empty.append(s)
-            else:
-                l_set_after.append(s)
-
-        l_got_s=[]
-        l_set_none=[]
-        l_set_empty=[]
-        l_set_after=[]
-        unaligned=self.make_dirfile('UNALIGNED', get_s, set_s, 0)
-        unaligned.fit_file()
-        self.assertEqual(l_set_none,[3,4,5])
-        self.assertEqual(l_got_s, [3,4,5,5])
-        self.assertEqual(l_set_empty,[3,4])
-        self.assertEqual(l_set_after, [5])
-        self.assertFalse(unaligned.is_conflicting())
-
-        def get_conflicting(s):
-            if s==5:
-                return None
-            else:
-                l_got_s.append(s)
-                return [0]*sectorlen
-
-        l_got_s=[]
-        l_set_none=[]
-        l_set_empty=[]
-        l_set_after=[]
-        conflicting=self.make_dirfile('UNALIGNED', get_conflicting, set_s, 0)
-        conflicting.registered=False
-        self.assertRaises(DirFileConflict, conflicting.register)
-        self.assertEqual(l_set_none,[])
-        self.assertEqual(l_set_empty,[])
-        self.assertEqual(l_set_after,[])
-        self.assertEqual(l_got_s, [3,4])
-        self.assertTrue(conflicting.is_conflicting())
-
 class DirDisc(DfsDisc):
-    def __init__(self, directory, verbose):
+    def __init__(self, directory, verbose, cache_budget=2**24):
+        '''
+        Read the unpacked disc in directory.  Up to cache_budget bytes of
+        file contents are kept in memory while the disc is being read.
+        '''
         super(DirDisc, self).__init__()
         self.dir=directory
         self.verbose=verbose
+        self.file_cache=FileCache(cache_budget)
+        self.fitted=False
         self.parse_dir()
 
+    @stats.timed('directory parsing')
     def parse_dir(self):
         parse=ParseUtils(self.dir,self.verbose)
-        with open(os.path.join(self.dir, '..THIS_DISK.inf'),'r') as f:
+        with stats.open(os.path.join(self.dir, '..THIS_DISK.inf'),'r') as f:
             for line in f.readlines():
                 if line.startswith('*OPT4,'):
                     self.boot_options=int(line[len('*OPT4,'):])
@@ -913,43 +1997,47 @@ class DirDisc(DfsDisc):
         def set_sector(s,v): self.set_unused_sector(s, v)
 
         cat=[]
-        for filename in os.listdir(self.dir):
+        files=list_files(self.dir)
+        for filename in files:
             if len(filename)!=0:
                 if filename[0] != '.':
                     f=DirFile(
-                      self.dir, filename, get_sector, set_sector, self.verbose
+                      self.dir, filename, get_sector, set_sector, self.verbose,
+                      self.file_cache, files[filename], files
                     )
                     cat.append(f)
 
-        # Identify unused catnums, and duplicate ones
-        free_nums=[]
+        # Identify duplicate catnums
+        cat=sorted(cat, key=lambda fil:fil.dir+'.'+fil.filename)
+        numbered=dict()
+        for fil in cat:
+            if fil.catnum in numbered:
+                if self.verbose:
+                    print('Info: File {} shares its catnum with {}'.format(
+                      fil.filename, numbered[fil.catnum].filename
+                    ),'(catnum={}); renumbering it'.format(
+                      fil.catnum
+                    ))
+                fil.catnum=None
+            elif fil.catnum!=None:
+                numbered[fil.catnum]=fil
+
+        # Order the catalogue by catnum, unnumbered files last, and close up
+        # any gaps in the numbering
+        self.cat=sorted(
+          [fil for fil in cat if fil.catnum!=None], key=lambda fil:fil.catnum
+        )+[fil for fil in cat if fil.catnum==None]
         for catnum in range(len(self.cat)):
-            f=[dirfil for dirfil in self.cat if dirfil.catnum==catnum]
-            if len(f)>1:
-                for fil in f[1:]:
-                    if self.verbose:
-                        print('Info: File {} shares its catnum with {}'.format(
-                          fil.filename, f[0].filename
-                        ),'(catnum={}); renumbering it'.format(
-                          fil.catnum
-                        ))
-                    fil.catnum=None
-            elif len(f)==0:
-                free_nums.append(catnum)
+            if self.cat[catnum].catnum!=catnum:
                 if self.verbose>=2:
-                    print('Info: Allocating catnum {} to a file'.format(catnum))
-            # else len(f)==1
-
-        # Assign unused catnums to unnumbered files
-        for f in [dirfil for dirfil in self.cat if dirfil.catnum==None]:
-            f.catnum=free_nums.pop(0)
-
-        assert len(free_nums)==0
-
-        self.cat=sorted(cat, key=lambda fil:fil.catnum)
+                    print('Info: Allocating catnum {} to {}'.format(
+                      catnum, self.cat[catnum].filename
+                    ))
+                self.cat[catnum].catnum=catnum
 
         # Read ..Empty.inf
         self.sector_data = dict()
+        self.sector_map = SectorMap(self.sectors or 0, used=True)
         self.unused_cat = [None, None]
 
         def ParseSector(sectornum, value):
@@ -967,11 +2055,14 @@ class DirDisc(DfsDisc):
                 if self.verbose:
                     print(message, 'too long; truncating')
                 data=data[0:sectorlen]
-            elif len(data) < sectorlen:
+            elif len(data) < sectorlen and (self.ssd_size==None or
+              (sectornum+1)*sectorlen <= self.ssd_size):
+                # Short sectors past the end of a cropped image stay short
                 if self.verbose:
                     print(message, 'too short; padding with zeroes')
-                data=data+[0]*(sectorlen-len(self.sector_data[sectornum]))
-            self.sector_data[sectornum]=data
+                data=to_bytes(data)
+                data=bytes(bytearray(data))+b'\0'*(sectorlen-len(data))
+            self.set_unused_sector(sectornum, data)
 
 
         def Sector0(value): self.unused_cat[0]=ParseSector(0,value)
@@ -980,7 +2071,7 @@ class DirDisc(DfsDisc):
           value, 'Warning: After disc image'
         )
 
-        with open(os.path.join(self.dir, '..Empty.inf'),'r') as f:
+        with stats.open(os.path.join(self.dir, '..Empty.inf'),'r') as f:
             for line in f.readlines():
                 if line.startswith('Sector '):
                     (parm, value)=line.split(':')
@@ -996,6 +2087,7 @@ class DirDisc(DfsDisc):
                       }, '..Empty.inf'
                     )
 
+    @stats.timed('fitting')
     def fit_files(self, enotc=False):
         '''
         Check the disc is defined fully and that all files fit in the space
@@ -1014,15 +2106,15 @@ class DirDisc(DfsDisc):
         # Check empty sectors are defined
         sec=2
         while sec<self.sectors:
-            fil=[f for f in self.cat if f.start_sector==sec]
+            fil=[f for f in self.cat if f.start_sector==sec and f.len>0]
             if len(fil)==0:
-                if sec not in self.sector_data.keys():
+                if not self.sector_map.is_free(sec):
                     if sec*sectorlen>self.ssd_size:
                         m='assuming empty'
-                        self.sector_data[sec]=[]
+                        self.set_unused_sector(sec, [])
                     else:
                         m='assuming blank'
-                        self.sector_data[sec]=[0]*sectorlen
+                        self.set_unused_sector(sec, [0]*sectorlen)
                     if self.verbose>=2:
                         print(
                           'Warning: No data for sector {:03x};'.format(sec), m
@@ -1037,153 +2129,284 @@ class DirDisc(DfsDisc):
                         )
                     for f in fil[1:]:
                         f.registered=False # TODO: Need to unregister instead?
-                else:
-                    sec-=fil[0].len//-sectorlen
+                sec-=fil[0].len//-sectorlen
 
         # Record used sectors and check for conflicts
         for fil in self.cat:
             fil.fit_file()
 
-        # Iterate over conflicting files, biggest first
+        # Place conflicting files, biggest first
         have_compacted=False # Offer the user the option of compacting
         was_cropped=False # Record if after expanding, we need to re-crop
-        for fil in sorted(
-          [f for f in self.cat if f.is_conflicting()], key=lambda f:f.len,
-          reverse=True
-        ):
-            size=-fil.len//-sectorlen
-            moved=False
-            offend=False # Run into end of a cropped disc
-            # Try to find a place for this file
-            for s in range(2, self.sectors-size):
-                space=True
-                # Check for space at this position
-                for se in range(s, s+size):
-                    if se >= self.sectors:
-                        space=False
-                        break # Stop check for space
-                    d=self.read_unused_sector(se)
-                    if d == None:
-                        # Sector is in use
-                        space=False
-                        break # Stop check for space
-                    elif d == '':
-                        # Sector is off the end of a truncated files
-                        offend=True
-                        space=False
-                        break # Stop check for space
-                if space:
-                    fil.move(s)
-                    moved=True
-                    break # Stop try to find a place
-                if offend:
-                    break # Stop try to find a place
-            while not moved:
-                # File doesn't fit
-                if have_compacted and self.sectors==800 and not offend:
-                    raise RuntimeError(
-                        'ERROR: Files don\'t even fit on a double density'+
-                        ' disc; aborting'
-                    )
-                if enotc == False:
-                    # Compacted last time; still doesn't fit
-                    e=''
-                    if verbose:
-                        while e!='y' and e!='n':
-                            print(
-                              'Warning: Have compacted,',
-                              'but files still don\'t fit\nExpand',
-                              'the disc image? ',end=''
-                            )
-                            try:
-                                e=input('[Yn]').lower()[0]
-                            except IndexError:
-                                e=''
-                    if e=='n':
-                        raise RuntimeError('Can\'t expand disc to fit files')
-                    else:
-                        enotc=True
-                elif enotc == None:
-                    # Don't know what the user wants
-                    ec=''
-                    if verbose:
-                        while ec != 'c' and ec != 'e':
-                            print(
-                              'Warning: Files do not fit in the allocated',
-                              'space.\nExpand the disc image, or compact',
-                              'it? ',end='')
-                            try:
-                                ec=input(
-                                  '[Ec]'
-                                ).lower()[0]
-                            except IndexError:
-                                ec=''
-                    if ec=='c':
-                        enotc=False
-                    else:
-                        enotc=True
-                assert enotc!=None
+        while True:
+            conflicting=[f for f in self.cat if f.is_conflicting()]
+            if len(conflicting)==0:
+                break
+            fil=max(conflicting, key=lambda f:f.len)
+            size=-(-fil.len//sectorlen)
+            # Try to find a place for this file, in the smallest hole it fits
+            # that's not past the end of a cropped disc
+            s=self.sector_map.find_free_run(
+              size, lambda start:not self.__is_cropped(start, size)
+            )
+            if s!=None:
+                fil.move(s)
+                continue
+            # Run into end of a cropped disc?
+            offend=self.sector_map.find_free_run(size)!=None
+            # File doesn't fit
+            if self.sectors>=800 and not offend and (have_compacted or enotc):
+                raise RuntimeError(
+                    'ERROR: Files don\'t even fit on a double density'+
+                    ' disc; aborting'
+                )
+            if enotc == False and have_compacted:
+                # Compacted last time; still doesn't fit
+                e=''
+                if self.verbose:
+                    while e!='y' and e!='n':
+                        print(
+                          'Warning: Have compacted,',
+                          'but files still don\'t fit\nExpand',
+                          'the disc image? ',end=''
+                        )
+                        try:
+                            e=input('[Yn]').lower()[0]
+                        except IndexError:
+                            e=''
+                if e=='n':
+                    raise RuntimeError('Can\'t expand disc to fit files')
+                else:
+                    enotc=True
+            elif enotc == None:
+                # Don't know what the user wants
+                ec=''
+                if self.verbose:
+                    while ec != 'c' and ec != 'e':
+                        print(
+                          'Warning: Files do not fit in the allocated',
+                          'space.\nExpand the disc image, or compact',
+                          'it? ',end='')
+                        try:
+                            ec=input(
+                              '[Ec]'
+                            ).lower()[0]
+                        except IndexError:
+                            ec=''
+                if ec=='c':
+                    enotc=False
+                else:
+                    enotc=True
+            assert enotc!=None
 
-                if enotc:
-                    # Expand disc
-                    if offend:
-                        was_cropped=True
-                    else:
-                        # Disc full - add sectors
-                        if self.sectors<400:
-                            self.sectors=400
-                        elif self.sectors<800:
-                            self.sectors=800
-                    # Fill in cropped sectors
-                    for s in range(self.sectors):
-                        d=self.read_unused_sector(s)
-                        if d!=None:
-                            # Sector not in use
-                            if len(d)<sectorlen:
-                                d+=[0]*(sectorlen-len(d))
-                                self.set_sector(s,d)
+            if enotc:
+                # Expand disc
+                if offend:
+                    was_cropped=True
                 else:
-                    # Compact
-                    for f in self.cat:
+                    # Disc full - add sectors
+                    old_size=self.sectors*sectorlen
+                    if self.sectors<400:
+                        self.sectors=400
+                    elif self.sectors<800:
+                        self.sectors=800
+                    self.sector_map.resize(self.sectors)
+                    if self.ssd_size!=None and self.ssd_size>=old_size:
+                        # Image wasn't cropped, so grow it with the disc
+                        self.ssd_size+=self.sectors*sectorlen-old_size
+                # Fill in cropped and newly added sectors
+                for s in self.sector_map.unused():
+                    d=self.sector_data.get(s, [])
+                    if len(d)<sectorlen:
+                        d=bytearray(to_bytes(d))
+                        self.set_unused_sector(
+                          s, bytes(d+bytearray(sectorlen-len(d)))
+                        )
+            else:
+                # Compact
+                for f in self.cat:
+                    if f.registered:
                         f.unregister()
-                    s=2
-                    try:
-                        for f in self.cat:
-                            f.move(s)
-                            s-=f.len//-sectorlen
-                        moved=True
-                    except DirFileFailure:
-                        pass # Not all files fit - 'moved' remains False
-                    have_compacted=True
+                s=2
+                try:
+                    for f in self.cat:
+                        f.move(s)
+                        s-=f.len//-sectorlen
+                except DirFileFailure:
+                    pass # Not all files fit; the rest remain conflicting
+                have_compacted=True
+        if was_cropped and self.ssd_size!=None:
+            # Re-crop just after the last file placed beyond the old end
+            end=max(
+              [(f.start_sector-(f.len//-sectorlen))*sectorlen
+                for f in self.cat if f.registered]+[0]
+            )
+            if end>self.ssd_size:
+                self.ssd_size=end
+        self.fitted=True
+
+    def build_ssd(self):
+        if not self.fitted:
+            self.fit_files()
+        return super(DirDisc, self).build_ssd()
+
+    def manifest(self, previous=None):
+        '''
+        Describe the fitted disc: a hash of the metadata files, and each file's
+        size, mtime, hash and sector range.  Hashes are carried over from the
+        previous manifest for files whose size and mtime haven't changed.
+        '''
+        import hashlib
+        if not self.fitted:
+            self.fit_files()
+        meta=hashlib.sha1()
+        for filename in sorted(os.listdir(self.dir)):
+            if filename.startswith('.'):
+                with stats.open(os.path.join(self.dir, filename),'rb') as handle:
+                    meta.update(to_bytes(filename)+b'\0'+handle.read()+b'\0')
+        previous=(previous or {}).get('files', {})
+        files={}
+        for f in self.cat:
+            stat=os.stat(f.path)
+            entry={
+              'start': f.start_sector, 'length': f.len,
+              'size': stat.st_size, 'mtime': stat.st_mtime
+            }
+            old=previous.get(f.dir+'.'+f.name, {})
+            if old.get('size')==entry['size'] and \
+              old.get('mtime')==entry['mtime'] and 'sha1' in old:
+                entry['sha1']=old['sha1']
+            else:
+                entry['sha1']=hashlib.sha1(to_bytes(f.read())).hexdigest()
+            files[f.dir+'.'+f.name]=entry
+        return {
+          'sectors': self.sectors, 'ssd_size': self.ssd_size,
+          'meta': meta.hexdigest(), 'files': files
+        }
+
+    @stats.timed('packing')
+    def update_ssd(self, filename, manifest=None):
+        '''
+        Bring the image in filename up to date with the directory, rewriting
+        only the catalogue and the sectors of files that have changed since it
+        was last packed.  The manifest recording what was packed is kept in
+        filename+'.manifest' unless given.  If there's no usable manifest, or
+        the disc's layout has changed, the whole image is written instead.
+
+        Returns the number of sectors rewritten.
+        '''
+        import json
+        if manifest==None:
+            manifest=filename+'.manifest'
+        try:
+            with stats.open(manifest,'r') as handle:
+                previous=json.load(handle)
+            stat=os.stat(filename)
+            if previous.get('image')!=[stat.st_size, stat.st_mtime]:
+                previous=None # Image changed since the manifest was written
+        except (IOError, OSError, ValueError):
+            previous=None
+        current=self.manifest(previous)
+
+        if previous==None or any(
+          [previous.get(k)!=current[k] for k in ('sectors','ssd_size','meta')]
+        ):
+            self.write_as_ssd(filename)
+            written=self.sectors
+        else:
+            dirty=set()
+            def mark(entry):
+                dirty.update(range(
+                  entry['start'], entry['start']-entry['length']//-sectorlen
+                ))
+            for (name, entry) in current['files'].items():
+                old=previous['files'].get(name)
+                if old==None:
+                    mark(entry)
+                elif [old[k] for k in ('start','length','sha1')] != \
+                  [entry[k] for k in ('start','length','sha1')]:
+                    mark(old)
+                    mark(entry)
+            for (name, entry) in previous['files'].items():
+                if name not in current['files']:
+                    mark(entry)
+            size=self.ssd_size
+            if size==None:
+                size=self.sectors*sectorlen
+            with stats.open(filename,'r+b') as handle:
+                handle.write(b''.join(self.catalogue_sectors()))
+                dirty=sorted([s for s in dirty if s*sectorlen<size])
+                written=2+len(dirty)
+                while dirty:
+                    # Write each run of consecutive sectors in one go
+                    count=1
+                    while count<len(dirty) and dirty[count]==dirty[0]+count:
+                        count+=1
+                    offset=dirty[0]*sectorlen
+                    handle.seek(offset)
+                    handle.write(
+                      self.read(dirty[0], count*sectorlen)[:size-offset]
+                    )
+                    dirty=dirty[count:]
+        stat=os.stat(filename)
+        current['image']=[stat.st_size, stat.st_mtime]
+        with stats.open(manifest,'w') as handle:
+            json.dump(current, handle, indent=1, sort_keys=True)
+        return written
+
+    def __is_cropped(self, start, count):
+        '''
+        Report whether any of the free sectors from start on fall off the end
+        of a cropped disc image
+        '''
+        for s in range(start, start+count):
+            if len(self.sector_data.get(s, [])) < sectorlen:
+                return True
+        return False
 
     def read(self, start_sector, length):
-        d=b''
-        for s in range(start_sector, start_sector-(length//-sectorlen)+1):
-            d+=self.read_sector(s)
-        return d[:length]
+        '''
+        Return length bytes of the disc from start_sector onwards.  Each file
+        in the range is looked up and read once, and copied into place.
+        '''
+        data=bytearray(length)
+        end=start_sector-(length//-sectorlen)
+        files=sorted(
+          [f for f in self.cat if f.registered],
+          key=lambda fil:fil.start_sector
+        )
+        starts=[f.start_sector for f in files]
+        sector=start_sector
+        while sector<end:
+            offset=(sector-start_sector)*sectorlen
+            unused=self.read_unused_sector(sector)
+            if sector<=1 or unused!=None:
+                chunk=to_bytes(self.read_sector(sector) if sector<=1 else unused)
+                next_sector=sector+1
+            else:
+                i=bisect.bisect_right(starts, sector)-1
+                f=files[i] if i>=0 else None
+                if f==None or f.start_sector-f.len//-sectorlen<=sector:
+                    raise ValueError('Missing data for sector {}'.format(sector))
+                next_sector=min(end, f.start_sector-f.len//-sectorlen)
+                ss=(sector-f.start_sector)*sectorlen
+                chunk=f.read()[ss:ss+(next_sector-sector)*sectorlen]
+                if len(chunk)<(next_sector-sector)*sectorlen:
+                    # Reached the file's last sector; add the data after it
+                    chunk+=bytes(bytearray(to_bytes(f.read_after())))
+            count=min(len(chunk), (next_sector-sector)*sectorlen, length-offset)
+            data[offset:offset+count]=chunk[:count]
+            sector=next_sector
+        return bytes(data)
 
     def list_unused_sectors(self):
-        return self.sector_data.keys()
+        return self.sector_map.unused()
 
     def read_sector(self, sector):
-        if sector<=1:
-            title='{:12s}'.format(self.title)
-            if sector==0:
-                sectordata=[ord(c) for c in title[0:8]]
-                for f in self.cat:
-                    sectordata+=f.get_cat_data()
-                sectordata+=self.read_unused_catalogue()[0]
-            elif sector==1:
-                sectordata=[ord(c) for c in title[9:]] # Bytes 0-3
-                sectordata+=self.serial_no # Byte 4
-                sectordata+=len(self.cat)<<3 # Byte 5
-                sectordata+=(self.sectors >> 8) & 0x07 + (
-                  self.boot_options << 4
-                ) # Byte 6
-                sectordata+=self.sectors & 0xff # Byte 7
-                sectordata+=self.read_unused_catalogue()[1]
-            else:
-                raise IndexError('Negative sector asked for!')
+        if sector<0:
+            raise IndexError('Negative sector asked for!')
+        elif sector<=1:
+            sectordata=self.catalogue_sectors()[sector]
         else:
             sectordata=self.read_unused_sector(sector)
             if sectordata==None:
@@ -1195,108 +2418,245 @@ class DirDisc(DfsDisc):
                     raise ValueError('Missing data fo sector {}'.format(sector))
                 # Read the data and split it
                 ss=(sector-f.start_sector)*sectorlen
-                sectordata=(f.read()+f.read_after())[ss:ss+sectorlen]
-        assert len(sectordata) == sectorlen
+                sectordata=f.read()[ss:ss+sectorlen]
+                if len(sectordata)<sectorlen:
+                    sectordata+=bytes(bytearray(to_bytes(f.read_after())))
+                    sectordata=sectordata[:sectorlen]
         return sectordata
 
     def read_unused_sector(self, sector):
-        if sector in self.sector_data.keys():
-            return self.sector_data[sector]
+        if self.sector_map.is_free(sector):
+            return self.sector_data.get(sector)
         else:
             return None
 
     def set_unused_sector(self, sector, data):
         if data == None:
             # Sector is now used, contrary to the name of this function
-            try:
-                del self.sector_data[sector]
-            except KeyError:
-                pass # Sector already used
-        elif hasattr(data,'encode'):
-            # Data not in raw bytes form; probably a string.
-            data=data
-        self.sector_data[sector]=data
+            self.sector_map.allocate(sector)
+            self.sector_data.pop(sector, None)
+        else:
+            self.sector_map.release(sector)
+            self.sector_data[sector]=bytes(bytearray(to_bytes(data)))
 
     def read_unused_catalogue(self):
         return self.unused_cat
 
-class TestDirDiscData(unittest.TestCase):
-    def setUp(self):
-        self.f=DirDisc(os.path.join('test_data','DirTest1'),0)
-
-    def test_boot_opts(self):
-        self.assertEqual(self.f.boot_options, 3)
-
-    def test_title(self):
-        self.assertEqual(self.f.title, 'DIRTEST1')
-
-    def test_serialno(self):
-        self.assertEqual(self.f.serial_no, 255)
-
-    def test_sectors(self):
-        self.assertEqual(self.f.sectors, 5)
-
-    def test_ssd_size(self):
-        self.assertEqual(self.f.ssd_size, 1280)
-
-class TestDirDiscMethods(unittest.TestCase):
-    def setUp(self):
-        self.unchanged=DirDisc(os.path.join('test_data','DirTest1'),2)
-        self.smallincrease=DirDisc(os.path.join('test_data','DirTest2'),2)
-
-    def test_fit_files(self):
-        self.unchanged.fit_files()
-        self.smallincrease.fit_files()
-        # TODO
-
-    def test_read(self):
-        self.smallincrease.fit_files()
-        self.assertEqual(self.smallincrease.read(2,len('passed')),b'passed')
-        pass # TODO
-
-    def test_list_unused_sectors(self):
-        pass # TODO
-
-    def test_read_sector(self):
-        pass # TODO
-
-    def test_read_unused_sector(self):
-        pass # TODO
-
-    def test_set_unused_sector(self):
-        pass # TODO
-
-    def test_read_unused_catalogue(self):
-        pass # TODO
-
 if __name__ == '__main__':
+    import argparse
+    import atexit
     pars=argparse.ArgumentParser(prog='dfstran', description='pack and unpack BBC Micro DFS disc images')
     pars.add_argument('--verbose', '-v', action='count', help='Report more details of the input')
-    pars.add_argument('input', help='The ssd file or directory to be processed')
-    pars.add_argument('output', nargs='?', help='The target file or folder for the input to be converted into')
+    pars.add_argument('input', help='The ssd or dsd file, or directory, to be processed')
+    pars.add_argument('output', nargs='*', help='The target file or folder for the input to be converted into; with --batch, more inputs followed by the folder to unpack them all into')
     pars.add_argument('--cat', '-c', action='store_true', help='List the contents of the input; do not convert')
+    pars.add_argument('--json', action='store_true', help='Catalogue the input as JSON Lines: an object for each disc, and with -v one for each file too')
+    pars.add_argument('--mmap', action='store_true', help='Map the input image into memory instead of reading it piece by piece')
+    pars.add_argument('--recursive', '-r', action='store_true', help='Catalogue every ssd file under the input directory, using a pool of processes')
+    pars.add_argument('--batch', '-b', action='store_true', help='Unpack several ssd files (or directories of them) concurrently, each into its own folder under the last output given')
+    pars.add_argument('--update', '-u', action='store_true', help='When packing, only rewrite the parts of an existing image that have changed since it was last packed')
+    pars.add_argument('--store', help='When unpacking, keep each distinct file once in this folder, and hard link it into each disc\'s folder')
+    pars.add_argument('--index', help='Add the catalogues of the input images (or all those under the input directory) to this database, only reading those that have changed')
+    pars.add_argument('--query', '-q', action='store_true', help='With --index, list the files in the database matching the input, which is a file name like $.ELITE, with * and # as wildcards')
+    pars.add_argument('--load', dest='load_address', type=lambda a:int(a,16), help='With --query, only list files with this (hex) load address')
+    pars.add_argument('--exec', dest='exec_address', type=lambda a:int(a,16), help='With --query, only list files with this (hex) execution address')
+    pars.add_argument('--stats', action='store_true', help='Report the file I/O done and the time spent in each phase of the work, once finished')
+    pars.add_argument('--profile', help='Profile the run with cProfile, saving the results to this file for the pstats module to read')
+    pars.add_argument('--jobs', '-j', type=int, help='The number of processes to use with --recursive or --batch (default: one per core)')
+    pars.add_argument('--threads', type=int, help='When unpacking, write this many of each disc\'s files at once')
     args=pars.parse_args()
-    if not os.path.exists(args.input):
+    if args.stats:
+        stats.enabled=True
+        if args.recursive or args.batch:
+            print('WARNING: --stats only counts work done in the main process,',
+              'not by the pool working on the images', file=sys.stderr
+            )
+        def report_stats():
+            sys.stderr.write(stats.summary())
+        atexit.register(report_stats)
+    if args.profile:
+        import cProfile
+        profiler=cProfile.Profile()
+        def save_profile():
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        atexit.register(save_profile)
+        profiler.enable()
+    if args.query:
+        if args.index==None:
+            pars.error('--query needs --index')
+        index=CatalogueIndex(args.index)
+        for (path, side, f) in index.query(
+          args.input, args.load_address, args.exec_address
+        ):
+            if is_dsd_name(path):
+                path+=' (drive {})'.format(DoubleSided.drives[side])
+            print('{}: {}'.format(path, f.info()))
+        index.close()
+        exit(0)
+    if args.batch:
+        if len(args.output)==0:
+            pars.error('--batch needs a folder to unpack into')
+        inputs=[args.input]+args.output[:-1]
+        for i in inputs[1:]:
+            if not os.path.exists(split_member(i)[0]):
+                print("ERROR: Input '{}' doesn't exist".format(i))
+                exit(2)
+        args.output=args.output[-1]
+    elif len(args.output)>1:
+        pars.error('only one output can be given without --batch')
+    else:
+        args.output=args.output[0] if args.output else None
+    if not os.path.exists(split_member(args.input)[0]):
         print("ERROR: Input '{}' doesn't exist".format(args.input))
         exit(2)
-    else:
-        d=SsdDisc(args.input)
 
     verbose=args.verbose
     if verbose==None:
         verbose=0
-    if args.cat:
+    if args.index!=None:
+        if os.path.isdir(args.input):
+            images=find_images(args.input)
+        elif args.input.lower().endswith('.zip'):
+            images=archives.images(args.input)
+        else:
+            images=[args.input]
+        index=CatalogueIndex(args.index)
+        (total, changed, failures)=(0, 0, 0)
+        for (path, change, error) in index.scan(images):
+            total+=1
+            if error!=None:
+                failures+=1
+                print("ERROR: Can't index {}: {}".format(path, error))
+            elif change:
+                changed+=1
+                if verbose:
+                    print('INFO: Indexed {}'.format(path))
+        removed=index.prune()
+        index.close()
+        print('INFO: {} image(s) checked; {} indexed, {} failed, {} removed'.format(
+          total, changed, failures, removed
+        ))
+        exit(1 if failures else 0)
+    if args.recursive:
+        if args.output!=None:
+            print('WARNING: Output given with --recursive option; not converting')
+        if os.path.isdir(args.input):
+            images=find_images(args.input)
+        elif args.input.lower().endswith('.zip'):
+            images=archives.images(args.input)
+        else:
+            images=[args.input]
+        failures=0
+        for (path, info, error) in catalogue_images(
+          images, verbose, args.mmap, args.jobs, args.json
+        ):
+            if error!=None:
+                failures+=1
+                if args.json:
+                    write_json(sys.stdout, [
+                      {'record': 'error', 'path': path, 'error': error}
+                    ])
+                else:
+                    print("ERROR: Can't catalogue {}: {}".format(path, error))
+            elif args.json:
+                sys.stdout.write(info)
+            else:
+                print('{}:\n{}'.format(path, info), end='')
+        if failures:
+            exit(1)
+        exit(0)
+
+    if args.batch:
+        start=time.time()
+        (done, failed, total_size)=(0, 0, 0)
+        for (path, directory, size, error) in unpack_images(
+          batch_targets(inputs, args.output), args.mmap, args.jobs,
+          args.store, args.threads
+        ):
+            if error!=None:
+                failed+=1
+                print("ERROR: Can't unpack {}: {}".format(path, error))
+            else:
+                done+=1
+                total_size+=size
+                if verbose:
+                    print('INFO: {} unpacked to {}'.format(path, directory))
+        elapsed=max(time.time()-start, 1e-6)
+        print('INFO: Unpacked {} of {} images in {:.2f}s'.format(
+          done, done+failed, elapsed
+        ), '({:.1f} images/s, {:.2f} MB/s); {} failed'.format(
+          done/elapsed, total_size/elapsed/2**20, failed
+        ))
+        if failed:
+            exit(1)
+        exit(0)
+
+    if os.path.isdir(args.input):
+        if is_dsd_dir(args.input):
+            d=DirDsdDisc(args.input, verbose)
+        else:
+            d=DirDisc(args.input, verbose)
+        d.fit_files()
+        if args.json:
+            write_json(sys.stdout, d.iter_records(verbose>0), path=args.input)
+            exit(0)
+        if args.cat:
+            if args.output!=None:
+                print('WARNING: Output given with --cat option; not converting')
+            d.write_info(sys.stdout, verbose)
+        elif args.output==None:
+            print('INFO: No output given; cataloging input')
+            d.write_info(sys.stdout, verbose)
+        else:
+            if verbose>1:
+                d.write_info(sys.stdout, verbose-2)
+            if isinstance(d, DirDsdDisc):
+                if args.update:
+                    print('WARNING: --update only works with ssd images;',
+                      'writing the whole image'
+                    )
+                d.write_as_dsd(args.output)
+                if verbose:
+                    print('INFO: {} packed into {}'.format(
+                      args.input, args.output
+                    ))
+            elif args.update:
+                written=d.update_ssd(args.output)
+                if verbose:
+                    print('INFO: {} updated; {} sector(s) rewritten'.format(
+                      args.output, written
+                    ))
+            else:
+                d.write_as_ssd(args.output)
+                if verbose:
+                    print('INFO: {} packed into {}'.format(
+                      args.input, args.output
+                    ))
+        exit(0)
+
+    d=open_image(args.input, mapped=args.mmap)
+    if args.json:
+        if args.output!=None:
+            print('WARNING: Output given with --json option; not converting',
+              file=sys.stderr
+            )
+        write_json(sys.stdout, d.iter_records(verbose>0), path=args.input)
+    elif args.cat:
         if args.output!=None:
             print('WARNING: Output given with --cat option; not converting')
-        print(d.info(verbose), end='')
+        d.write_info(sys.stdout, verbose)
     else:
         if args.output==None:
             print('INFO: No output given; cataloging input')
-            print(d.info(verbose), end='')
+            d.write_info(sys.stdout, verbose)
         if args.output!=None:
             if verbose>1:
-                print(d.info(verbose-2), end='')
-            d.write_as_files(args.output)
+                d.write_info(sys.stdout, verbose-2)
+            d.write_as_files(
+              args.output, BlobStore(args.store) if args.store else None,
+              args.threads
+            )
             if verbose:
                 print('INFO: {} unpacked to {}'.format(
                   args.input, args.output
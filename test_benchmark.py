@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''
+Tests for benchmark.py, and that dfstran starts quickly.  Run them from the
+top of the repository with:
+
+    python -m unittest test_benchmark
+'''
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import unittest
+
+import dfstran
+import benchmark
+
+class TestSyntheticDisc(unittest.TestCase):
+    def test_layouts(self):
+        for (name, layout) in benchmark.scenarios:
+            disc=benchmark.SyntheticDisc(**layout)
+            image=disc.build_ssd()
+            self.assertEqual(len(image), disc.ssd_size)
+            work=tempfile.mkdtemp(prefix='dfstran-bench-')
+            try:
+                path=os.path.join(work, name+'.ssd')
+                with open(path,'wb') as handle:
+                    handle.write(image)
+                d=dfstran.SsdDisc(path)
+                self.assertEqual(len(d.cat), len(layout['sizes']))
+                self.assertEqual(d.sectors, layout['tracks']*10)
+                self.assertEqual(
+                  dfstran.to_bytes(d.cat[-1].read()), disc.cat[-1].data
+                )
+                d.close()
+            finally:
+                shutil.rmtree(work)
+
+    def test_compare(self):
+        old={'results': {'a': {'readcat': 1.0}}}
+        new={'results': {'a': {'readcat': 2.0, 'info0': 1.0}}}
+        self.assertEqual(
+          [slower for (line, slower) in benchmark.compare(old, new, 1.25)],
+          [False, True]
+        )
+
+class TestStartup(unittest.TestCase):
+    def test_deferred_imports(self):
+        loaded=subprocess.check_output([sys.executable, '-c',
+          'import sys, dfstran; print(" ".join(sys.modules))'
+        ]).decode('ascii').split()
+        self.assertEqual([m for m in benchmark.deferred if m in loaded], [])
+
+if __name__ == '__main__':
+    unittest.main()